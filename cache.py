@@ -0,0 +1,210 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+SYM_VERSION = 1  # bump when the symmetry stage changes its results
+
+
+def hash_str(str_dict):
+    """
+    hash the content of a structure that the cluster counts depend on
+    :param str_dict: structure metadata from parse_str function
+    :return: hex digest of lattice vectors, positions, species and spins
+    """
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(str_dict['LatVec'], dtype=float).tobytes())
+    sha.update(np.ascontiguousarray(str_dict['LatPnt'], dtype=float).tobytes())
+    sha.update(' '.join(map(str, str_dict['Spec'])).encode())
+    sha.update(np.ascontiguousarray(str_dict['Spin'], dtype=float).tobytes())
+
+    return sha.hexdigest()
+
+
+def hash_clust(symeq_clust_list):
+    """
+    hash the cluster set, i.e. the clusters from clust_in with all their symmetry equivalents from lat_in
+    :param symeq_clust_list: all symmetry equivalent clusters
+    :return: hex digest of the cluster set
+    """
+    return hashlib.sha1(json.dumps(symeq_clust_list).encode()).hexdigest()
+
+
+def hash_file(file_list):
+    """
+    hash the content of input files
+    :param file_list: list of file names
+    :return: hex digest of all files in sequence
+    """
+    sha = hashlib.sha1()
+    for name in file_list:
+        file_sha = hashlib.sha1()
+        with open(name, 'rb') as filehandle:
+            for chunk in iter(lambda: filehandle.read(1 << 20), b''):  # 1 MB at a time, large data files stream
+                file_sha.update(chunk)
+        sha.update(file_sha.digest())
+
+    return sha.hexdigest()
+
+
+def save_sym(path, sym_list, symeq_clust_list, perm_list):
+    """
+    write the symmetry stage as a compact binary file
+    :param path: name of the .npz file
+    :param sym_list: list of symmetry operations
+    :param symeq_clust_list: all symmetry equivalent clusters
+    :param perm_list: point symmetry site permutations of all symmetry equivalent clusters
+    """
+    header = [[len(symeq_clust), symeq_clust[0][1], symeq_clust[0][2]] if symeq_clust else [0, None, None]
+              for symeq_clust in symeq_clust_list]
+    coord = [site for symeq_clust in symeq_clust_list for clust in symeq_clust for site in clust[0]]
+    perm = [order for symeq_perm in perm_list for clust_perm in symeq_perm if clust_perm is not None
+            for order in clust_perm]
+    perm_num = [0 if clust_perm is None else len(clust_perm) for symeq_perm in perm_list for clust_perm in symeq_perm]
+    size = [len(clust[0]) for symeq_clust in symeq_clust_list for clust in symeq_clust]
+    with open(path + '.tmp', 'wb') as filehandle:
+        np.savez(filehandle, header=json.dumps(header), sym=np.array(sym_list, dtype=float).reshape(-1, 3, 3),
+                 coord=np.array(coord, dtype=float).reshape(-1, 3), size=np.array(size, dtype=np.int32),
+                 perm=np.array([x for order in perm for x in order], dtype=np.int8),
+                 perm_num=np.array(perm_num, dtype=np.int32))
+    os.replace(path + '.tmp', path)
+
+
+def load_sym(path):
+    """
+    read the symmetry stage written by save_sym
+    :param path: name of the .npz file
+    :return: list of symmetry operations, symmetry equivalent clusters and their point symmetry site permutations
+    """
+    with np.load(path) as data:
+        header = json.loads(str(data['header']))
+        sym_list = data['sym']
+        coord = data['coord'].tolist()
+        size = data['size'].tolist()
+        perm = data['perm']
+        perm_num = data['perm_num'].tolist()
+    symeq_clust_list = []
+    perm_list = []
+    c = 0  # cluster counter
+    s = 0  # site counter
+    p = 0  # permutation entry counter
+    for eq_num, dist, flag in header:
+        symeq_clust = []
+        symeq_perm = []
+        for k in range(eq_num):
+            symeq_clust.append([coord[s:s + size[c]], list(dist), list(flag)])
+            if perm_num[c] == 0:
+                symeq_perm.append(None)
+            else:
+                symeq_perm.append(perm[p:p + perm_num[c] * size[c]].reshape(perm_num[c], size[c]))
+            s += size[c]
+            p += perm_num[c] * size[c]
+            c += 1
+        symeq_clust_list.append(symeq_clust)
+        perm_list.append(symeq_perm)
+
+    return sym_list, symeq_clust_list, perm_list
+
+
+def sym_cached(sym_func, file_list, cache_dir):
+    """
+    load the symmetry stage for the given input files, or run it and keep the result for later runs
+    :param sym_func: function running the symmetry stage, e.g. symop.find_sym_stage with the inputs filled in
+    :param file_list: input files of the symmetry stage, i.e. lat_in and clust_in
+    :param cache_dir: directory of the symmetry files
+    :return: list of symmetry operations, symmetry equivalent clusters and their point symmetry site permutations
+    """
+    key = hashlib.sha1((hash_file(file_list) + str(SYM_VERSION)).encode()).hexdigest()
+    path = os.path.join(cache_dir, 'sym_' + key + '.npz')
+    if os.path.isfile(path):
+        return load_sym(path)
+    sym_list, symeq_clust_list, perm_list = sym_func()
+    os.makedirs(cache_dir, exist_ok=True)
+    save_sym(path, sym_list, symeq_clust_list, perm_list)
+
+    return sym_list, symeq_clust_list, perm_list
+
+
+def load_count(cache_dir, key):
+    """
+    read the count list of a structure from the cache and mark it as recently used
+    :param cache_dir: directory of the count cache
+    :param key: key of the structure from hash_str and hash_clust
+    :return: count list of the structure, None if not cached
+    """
+    path = os.path.join(cache_dir, key + '.json')
+    try:
+        with open(path, 'r') as filehandle:
+            count_list = json.load(filehandle)
+    except (OSError, ValueError):
+        return None
+    os.utime(path)
+
+    return count_list
+
+
+def save_count(cache_dir, key, count_list):
+    """
+    write the count list of a structure to the cache
+    :param cache_dir: directory of the count cache
+    :param key: key of the structure from hash_str and hash_clust
+    :param count_list: count list of the structure
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + '.json')
+    with open(path + '.tmp', 'w') as filehandle:
+        json.dump(count_list, filehandle)
+    os.replace(path + '.tmp', path)  # never leave a partial entry behind
+
+
+def evict(cache_dir, max_size):
+    """
+    remove the least recently used entries until the cache is not larger than max_size
+    :param cache_dir: directory of the count cache
+    :param max_size: maximum size of the cache in MB, no limit if None
+    :return: number of removed entries
+    """
+    if max_size is None or not os.path.isdir(cache_dir):
+        return 0
+    entry_list = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.json'):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entry_list.append([stat.st_mtime, stat.st_size, name])
+    entry_list.sort()
+    total = sum(entry[1] for entry in entry_list)
+    removed = 0
+    for mtime, size, name in entry_list:
+        if total <= max_size * 1e6:
+            break
+        os.remove(os.path.join(cache_dir, name))
+        total -= size
+        removed += 1
+
+    return removed
+
+
+def count_cached(count_func, str_list, symeq_clust_list, cache_dir, max_size=None):
+    """
+    count only the structures that are not in the cache yet and merge them with the cached ones
+    :param count_func: function counting a list of structures, e.g. count_vector with the clusters filled in
+    :param str_list: parsed DFT data list
+    :param symeq_clust_list: all symmetry equivalent clusters
+    :param cache_dir: directory of the count cache
+    :param max_size: maximum size of the cache in MB, no limit if None
+    :return: list of the count number (count_list) in the same sequence as str_list, number of hits and misses
+    """
+    clust_key = hash_clust(symeq_clust_list)
+    key_list = [hashlib.sha1((clust_key + hash_str(str_dict)).encode()).hexdigest() for str_dict in str_list]
+    cached_list = [load_count(cache_dir, key) for key in key_list]
+    miss_list = [str_dict for str_dict, cached in zip(str_list, cached_list) if cached is None]
+    new_count = iter(count_func(miss_list) if miss_list else [])
+    count_list_all = []
+    for str_dict, key, cached in zip(str_list, key_list, cached_list):
+        if cached is None:
+            cell_name, cached = next(new_count)
+            save_count(cache_dir, key, cached)
+        count_list_all.append([str_dict['CellName'], cached])
+    evict(cache_dir, max_size)
+
+    return count_list_all, len(str_list) - len(miss_list), len(miss_list)
@@ -1,39 +1,77 @@
+import os
+import time
 import symop
+import timing
 import json
+import itertools
+import contextlib
+import functools
+import multiprocessing
 import yaml
 import numpy as np
+from scipy import sparse
 from sklearn.linear_model import LinearRegression
 from sklearn.linear_model import LassoCV
 from sklearn.linear_model import RidgeCV
 from sklearn.linear_model import ElasticNetCV
+from sklearn.linear_model import enet_path
 from sklearn.metrics import mean_squared_error
+from sklearn.metrics import r2_score
 from sklearn.model_selection import KFold
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import normalize
 from sklearn.utils import resample
 
-with open('param_in', 'r') as stream:
-    param = yaml.safe_load(stream)
-n = int(param['sample_times'])
-sample_ratio = float(param['sample_ratio'])
-kfold = int(param['kfold'])
-alpha_range = param['alpha_range']
-l1 = param['l1_ratio']
-coef_tol = float(param['convergence'])
-kf = KFold(n_splits=kfold, shuffle=True, random_state=123456)
-alpha_cv = np.logspace(alpha_range[0], alpha_range[1], num=100)
+_config = None  # fitting configuration from param_in, read on first use
 
 
-def all_data_norm(count, enrg):
+def load_config(param):
+    """
+    build the fitting configuration from the fit options of param_in
+    :param param: dictionary of the param_in options
+    :return: dictionary with the bootstrap, cross validation and engine settings
+    """
+    config = {'n': int(param['sample_times']), 'sample_ratio': float(param['sample_ratio']),
+              'kfold': int(param['kfold']), 'alpha_range': param['alpha_range'], 'l1': param['l1_ratio'],
+              'coef_tol': float(param['convergence']), 'fit_workers': int(param.get('fit_workers', 1)),
+              'fit_engine': param.get('fit_engine', 'sklearn'), 'alpha_window': param.get('alpha_window', None),
+              'ridge_gcv': param.get('ridge_gcv', False), 'fit_dir': param.get('fit_dir', '')}
+    if config['alpha_window'] is not None and int(config['alpha_window']) < 0:
+        raise ValueError('alpha_window must be a non-negative number of grid points, got ' +
+                         str(config['alpha_window']))
+    config['kf'] = KFold(n_splits=config['kfold'], shuffle=True, random_state=123456)
+    config['alpha_cv'] = np.logspace(config['alpha_range'][0], config['alpha_range'][1], num=100)
+
+    return config
+
+
+def get_config(config=None):
+    """
+    return the given configuration, or the one from param_in in the working directory if None
+    :param config: configuration from load_config or None
+    :return: fitting configuration
+    """
+    global _config
+    if config is not None:
+        return config
+    if _config is None:
+        with open('param_in', 'r') as stream:
+            _config = load_config(yaml.safe_load(stream))
+    return _config
+
+
+def all_data_norm(count, enrg, config=None):
     """
     Normalized lasso fitting to all data
     :param enrg: energy list
     :param count: count list containing clusters, decorations, and counts
+    :param config: fitting configuration from load_config, read from param_in if None
     :return: list of ECIs
     """
+    config = get_config(config)
     coef_list = []
     count_norm = normalize(count)
-    model = LassoCV(alphas=alpha_cv, cv=kf, max_iter=1000000000, tol=coef_tol)
+    model = LassoCV(alphas=config['alpha_cv'], cv=config['kf'], max_iter=1000000000, tol=config['coef_tol'])
     model.fit(count_norm, enrg)
     coef_list.append(model.intercept_)
     coef_list.extend(model.coef_.tolist())
@@ -45,15 +83,17 @@ def all_data_norm(count, enrg):
     return coef_list
 
 
-def all_data_lasso(count, enrg):
+def all_data_lasso(count, enrg, config=None):
     """
     Lasso fitting to all data
     :param enrg: energy list
     :param count: count list containing clusters, decorations, and counts
+    :param config: fitting configuration from load_config, read from param_in if None
     :return: list of ECIs
     """
+    config = get_config(config)
     coef_list = []
-    model = LassoCV(alphas=alpha_cv, cv=kf, max_iter=1000000000, tol=coef_tol)
+    model = LassoCV(alphas=config['alpha_cv'], cv=config['kf'], max_iter=1000000000, tol=config['coef_tol'])
     model.fit(count, enrg)
     coef_list.append(model.intercept_)
     coef_list.extend(model.coef_.tolist())
@@ -66,15 +106,17 @@ def all_data_lasso(count, enrg):
     return coef_list
 
 
-def all_data_loocv_ridge(count, enrg):
+def all_data_loocv_ridge(count, enrg, config=None):
     """
     Ridge LOO CV fitting to all data
     :param enrg: energy list
     :param count: count list containing clusters, decorations, and counts
+    :param config: fitting configuration from load_config, read from param_in if None
     :return: list of ECIs
     """
+    config = get_config(config)
     coef_list = []
-    model = RidgeCV(alphas=alpha_cv)
+    model = RidgeCV(alphas=config['alpha_cv'])
     model.fit(count, enrg)
     coef_list.append(model.intercept_)
     coef_list.extend(model.coef_.tolist())
@@ -87,115 +129,516 @@ def all_data_loocv_ridge(count, enrg):
     return coef_list
 
 
-def ridge_fit(count, enrg):
+def gram_path(x, y, w, alphas, l1_ratio, config, coef_init=None):
+    """
+    elastic net path over the rows of x repeated w times, solved on the weighted Gram matrix
+    :param x: dense count matrix of all structures
+    :param y: energy array of all structures
+    :param w: number of times each structure is drawn
+    :param alphas: alphas in descending order
+    :param l1_ratio: l1_ratio of the elastic net, 1 for lasso
+    :param config: fitting configuration
+    :param coef_init: coefficients to start the first alpha from
+    :return: intercepts (n_alphas,) and coefficients (n_features, n_alphas) along the path
+    """
+    keep = w > 0
+    w_sum = w.sum()
+    x_mean = w @ x / w_sum
+    y_mean = w @ y / w_sum
+    root_w = np.sqrt(w[keep])
+    xw = np.asfortranarray((x[keep] - x_mean) * root_w[:, None])
+    xw[:, np.ptp(x[keep], axis=0) == 0] = 0  # constant columns stay out of the fit instead of centering to noise
+    yw = (y[keep] - y_mean) * root_w
+    gram = xw.T @ xw
+    xy = xw.T @ yw
+    # enet_path scales the penalty by the number of rows, which is the number of draws here
+    scale = w_sum / len(yw)
+    _, coefs, _ = enet_path(xw, yw, l1_ratio=l1_ratio, alphas=alphas * scale, precompute=gram, Xy=xy,
+                            coef_init=coef_init, max_iter=1000000000, tol=config['coef_tol'],
+                            check_input=False)
+
+    return y_mean - x_mean @ coefs, coefs
+
+
+def gram_cv(x, y, idx, alphas, l1_list, config):
+    """
+    cross validated elastic net on the rows idx of x, following LassoCV/ElasticNetCV with the folds from kf
+    :param x: dense count matrix of all structures
+    :param y: energy array of all structures
+    :param idx: drawn structure indices, np.arange(len(y)) for all data
+    :param alphas: alpha grid
+    :param l1_list: list of l1_ratio to choose from
+    :param config: fitting configuration
+    :return: best alpha, best l1_ratio, intercept, coefficients, mse path (n_l1, n_alphas, n_folds)
+    """
+    alphas = np.sort(alphas)[::-1]
+    folds = list(config['kf'].split(idx))
+    mse_path = np.empty((len(l1_list), len(alphas), len(folds)))
+    fold_coef = []
+    for j, l1_ratio in enumerate(l1_list):
+        fold_coef.append([])
+        for k, (train, test) in enumerate(folds):
+            intercepts, coefs = gram_path(x, y, np.bincount(idx[train], minlength=len(y)), alphas, l1_ratio,
+                                          config)
+            resid = x[idx[test]] @ coefs + intercepts - y[idx[test], None]
+            mse_path[j, :, k] = np.mean(resid ** 2, axis=0)
+            fold_coef[j].append(coefs)
+    best_mse = np.inf
+    for j, mse_alphas in enumerate(mse_path.mean(axis=2)):
+        a = np.argmin(mse_alphas)
+        if mse_alphas[a] < best_mse:
+            best_j, best_a, best_mse = j, a, mse_alphas[a]
+    # refit on all drawn rows, starting from the fold solutions at the chosen alpha
+    coef_init = np.mean([coefs[:, best_a] for coefs in fold_coef[best_j]], axis=0)
+    intercepts, coefs = gram_path(x, y, np.bincount(idx, minlength=len(y)), alphas[best_a:best_a + 1],
+                                  l1_list[best_j], config, coef_init)
+
+    return alphas[best_a], l1_list[best_j], intercepts[0], coefs[:, 0], mse_path
+
+
+def svd_ridge(x, y, w, alphas):
+    """
+    ridge solutions for all alphas over the rows of x repeated w times, from a single SVD
+    :param x: dense count matrix of all structures
+    :param y: energy array of all structures
+    :param w: number of times each structure is drawn
+    :param alphas: alpha grid
+    :return: intercepts (n_alphas,), coefficients (n_features, n_alphas) and GCV score (n_alphas,)
+    """
+    keep = w > 0
+    w_sum = w.sum()
+    x_mean = w @ x / w_sum
+    y_mean = w @ y / w_sum
+    root_w = np.sqrt(w[keep])
+    vary = np.ptp(x[keep], axis=0) > 0  # constant columns get an exact zero like in Ridge
+    xw = (x[keep][:, vary] - x_mean[vary]) * root_w[:, None]
+    yw = (y[keep] - y_mean) * root_w
+    u, sv, vt = np.linalg.svd(xw, full_matrices=False)
+    uty = u.T @ yw
+    sv2 = sv[:, None] ** 2
+    coefs = np.zeros((len(vary), len(alphas)))
+    coefs[vary] = vt.T @ (sv[:, None] / (sv2 + alphas) * uty[:, None])  # filter factors for all alphas at once
+    rss = yw @ yw - uty @ uty + np.sum((alphas / (sv2 + alphas) * uty[:, None]) ** 2, axis=0)
+    dof = np.sum(sv2 / (sv2 + alphas), axis=0) + 1  # one more for the intercept
+    gcv = rss / w_sum / (1 - dof / w_sum) ** 2
+
+    return y_mean - x_mean @ coefs, coefs, gcv
+
+
+def ridge_cv(x, y, idx, alphas, config):
+    """
+    cross validated ridge on the rows idx of x, following RidgeCV with the folds from kf, or by GCV if ridge_gcv
+    :param x: dense count matrix of all structures
+    :param y: energy array of all structures
+    :param idx: drawn structure indices
+    :param alphas: alpha grid
+    :param config: fitting configuration
+    :return: best alpha, intercept, coefficients, CV score (mean R2 over the folds, or with GCV the R2 of the GCV
+             mean squared error against the variance of the drawn energies, so both are higher is better)
+    """
+    w = np.bincount(idx, minlength=len(y))
+    if config['ridge_gcv']:
+        intercepts, coefs, gcv = svd_ridge(x, y, w, alphas)
+        a = np.argmin(gcv)
+        y_var = w @ (y - w @ y / w.sum()) ** 2 / w.sum()
+        return alphas[a], intercepts[a], coefs[:, a], 1 - gcv[a] / y_var
+    score = []
+    for train, test in config['kf'].split(idx):
+        intercepts, coefs, _ = svd_ridge(x, y, np.bincount(idx[train], minlength=len(y)), alphas)
+        y_test = y[idx[test]]
+        resid = x[idx[test]] @ coefs + intercepts - y_test[:, None]
+        score.append(1 - np.sum(resid ** 2, axis=0) / np.sum((y_test - y_test.mean()) ** 2))
+    score = np.mean(score, axis=0)
+    a = np.argmax(score)
+    intercepts, coefs, _ = svd_ridge(x, y, w, alphas[a:a + 1])
+
+    return alphas[a], intercepts[0], coefs[:, 0], score[a]
+
+
+def narrow_alpha(x, y, l1_list, config):
+    """
+    keep only the alpha_window grid points on each side of the optimum alpha of all data
+    :param x: dense count matrix of all structures
+    :param y: energy array of all structures
+    :param l1_list: list of l1_ratio to choose from
+    :param config: fitting configuration
+    :return: narrowed alpha grid
+    """
+    best_alpha = gram_cv(x, y, np.arange(len(y)), config['alpha_cv'], l1_list, config)[0]
+    a = int(np.searchsorted(config['alpha_cv'], best_alpha))
+    return config['alpha_cv'][max(0, a - config['alpha_window']):a + config['alpha_window'] + 1]
+
+
+def fit_replicate(model_func, count, enrg, sample_size, i):
+    """
+    fit the i-th bootstrap replicate with a scikit-learn CV model
+    :return: coefficients and fitting attributes of the replicate
+    """
+    x, y = resample(count, enrg, n_samples=sample_size, random_state=i)
+    model = model_func()
+    model.fit(x, y)
+    coef = [model.intercept_]
+    coef.extend(model.coef_.tolist())
+    rmse = np.sqrt(mean_squared_error(model.predict(count), enrg))
+    score = model.score(count, enrg)
+    if hasattr(model, 'mse_path_'):
+        cvs = model.mse_path_.mean(axis=1).min()
+    else:
+        cvs = model.best_score_  # RidgeCV keeps the mean CV score of its alpha instead of a path
+    coef_num = np.sum(model.coef_ != 0)
+    if hasattr(model, 'l1_ratio_'):
+        return coef, [model.alpha_, model.l1_ratio_, rmse, score, coef_num, cvs]
+    return coef, [model.alpha_, rmse, score, coef_num, cvs]
+
+
+def fit_replicate_gram(alphas, l1_ratio, config, count, enrg, sample_size, i):
+    """
+    fit the i-th bootstrap replicate with gram_cv, drawing the same rows as fit_replicate
+    :param l1_ratio: list of l1_ratio for elastic net, a single value for lasso
+    :return: coefficients and fitting attributes of the replicate
+    """
+    idx = resample(np.arange(len(enrg)), n_samples=sample_size, random_state=i)
+    alpha, best_l1, intercept, coef_, mse_path = gram_cv(count, enrg, idx, alphas, np.atleast_1d(l1_ratio).tolist(),
+                                                         config)
+    pred = count @ coef_ + intercept
+    coef = [intercept]
+    coef.extend(coef_.tolist())
+    rmse = np.sqrt(mean_squared_error(enrg, pred))
+    score = r2_score(enrg, pred)
+    cvs = (mse_path[0] if len(mse_path) == 1 else mse_path).mean(axis=1).min()  # l1 axis dropped like mse_path_
+    coef_num = np.sum(coef_ != 0)
+    if np.ndim(l1_ratio):
+        return coef, [alpha, best_l1, rmse, score, coef_num, cvs]
+    return coef, [alpha, rmse, score, coef_num, cvs]
+
+
+def fit_replicate_ridge(alphas, config, count, enrg, sample_size, i):
+    """
+    fit the i-th bootstrap replicate with ridge_cv, drawing the same rows as fit_replicate
+    :return: coefficients and fitting attributes of the replicate
+    """
+    idx = resample(np.arange(len(enrg)), n_samples=sample_size, random_state=i)
+    alpha, intercept, coef_, cvs = ridge_cv(count, enrg, idx, alphas, config)
+    pred = count @ coef_ + intercept
+    coef = [intercept]
+    coef.extend(coef_.tolist())
+    rmse = np.sqrt(mean_squared_error(enrg, pred))
+    score = r2_score(enrg, pred)
+    coef_num = np.sum(coef_ != 0)
+
+    return coef, [alpha, rmse, score, coef_num, cvs]
+
+
+_pool_args = ()
+
+
+def _init_pool(fit_func, count, enrg, sample_size):
+    """
+    keep the count matrix and energies in each worker so they are only sent once at startup
+    """
+    global _pool_args
+    _pool_args = (fit_func, count, enrg, sample_size)
+
+
+def _fit_pool(i):
+    """
+    fit the i-th bootstrap replicate, seeded with i like the serial loop
+    """
+    fit_func, count, enrg, sample_size = _pool_args
+    start = time.perf_counter()
+    coef, attr = fit_func(count, enrg, sample_size, i)
+    return coef, attr, time.perf_counter() - start
+
+
+def bootstrap(fit_func, count, enrg, config, method='fit'):
+    """
+    fit n bootstrap replicates, spread over a process pool if fit_workers > 1
+    :param fit_func: fit_replicate or fit_replicate_gram with the model filled in
+    :param count: count list containing clusters, decorations, and counts
+    :param enrg: energy list
+    :param config: fitting configuration, with the number of replicates and fit_workers
+    :param method: name of the fitting method in the timing report
+    :return: coefficients and fitting attributes of each replicate in the sequence of the seeds
+    """
+    sample_size = round(config['sample_ratio'] * len(enrg))
+    _init_pool(fit_func, count, enrg, sample_size)
+    coef_list = []
+    attr_list = []
+    if config['fit_workers'] > 1:
+        pool = multiprocessing.Pool(config['fit_workers'], initializer=_init_pool, initargs=_pool_args)
+        result_list = pool.imap(_fit_pool, range(config['n']))  # keeps the sequence of the seeds
+    else:
+        pool = None
+        result_list = map(_fit_pool, range(config['n']))
+    try:
+        for coef, attr, seconds in result_list:
+            timing.add_replicate(method, seconds)
+            print(*attr, flush=True)
+            attr[-2] = float(attr[-2])
+            coef_list.append(coef)
+            attr_list.append(attr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return coef_list, attr_list
+
+
+def bootstrap_gram(l1_ratio, count, enrg, config, method='fit'):
+    """
+    fit n bootstrap replicates with the Gram matrix engine, on the alpha_window grid if set
+    :param l1_ratio: list of l1_ratio for elastic net, a single value for lasso
+    :param count: count list containing clusters, decorations, and counts
+    :param enrg: energy list
+    :param config: fitting configuration
+    :param method: name of the fitting method in the timing report
+    :return: coefficients and fitting attributes of each replicate in the sequence of the seeds
+    """
+    x = count.toarray() if sparse.issparse(count) else np.asarray(count, dtype=float)
+    y = np.asarray(enrg, dtype=float)
+    if config['alpha_window'] is None:
+        alphas = config['alpha_cv']
+    else:
+        alphas = narrow_alpha(x, y, np.atleast_1d(l1_ratio).tolist(), config)
+    fit_func = functools.partial(fit_replicate_gram, alphas, l1_ratio, config)
+
+    return bootstrap(fit_func, x, y, config, method)
+
+
+def ridge_fit(count, enrg, config=None):
     """
     Ridge fitting to energy per atom
     :param enrg: energy list
     :param count: count list containing clusters, decorations, and counts
+    :param config: fitting configuration from load_config, read from param_in if None
     :return: list of ECIs
     """
+    config = get_config(config)
     # bootstrap ridge
-    sample_size = round(sample_ratio * len(enrg))
-    attr_list = [[] for _ in range(n)]
-    coef_list = [[] for _ in range(n)]
     print('Ridge: alpha, rmse, score, coef_num, cvs', flush=True)
-    for i in range(n):
-        x, y = resample(count, enrg, n_samples=sample_size, random_state=i)
-        model = RidgeCV(alphas=alpha_cv, cv=kf)
-        model.fit(x, y)
-        coef_list[i].append(model.intercept_)
-        coef_list[i].extend(model.coef_.tolist())
-        rmse = np.sqrt(mean_squared_error(model.predict(count), enrg))
-        score = model.score(count, enrg)
-        cvs = model.mse_path_.mean(axis=1).min()
-        coef_num = np.sum(model.coef_ != 0)
-        print(model.alpha_, rmse, score, coef_num, cvs, flush=True)
-        attr_list[i].extend([model.alpha_, rmse, score, float(coef_num), cvs])
+    # dense for all engines, RidgeCV would switch to the iterative sparse_cg solver on a sparse matrix and give the
+    # constant columns small nonzero coefficients
+    x = count.toarray() if sparse.issparse(count) else np.asarray(count, dtype=float)
+    if config['fit_engine'] == 'gram' or config['ridge_gcv']:
+        fit_func = functools.partial(fit_replicate_ridge, config['alpha_cv'], config)
+        coef_list, attr_list = bootstrap(fit_func, x, np.asarray(enrg, dtype=float), config, 'ridge')
+    else:
+        model_func = functools.partial(RidgeCV, alphas=config['alpha_cv'], cv=config['kf'])
+        coef_list, attr_list = bootstrap(functools.partial(fit_replicate, model_func), x, enrg, config, 'ridge')
     coef_mean = np.mean(coef_list, axis=0)
-    with open('fit_coef_ridge', 'w') as filehandle:
+    with open(os.path.join(config['fit_dir'], 'fit_coef_ridge'), 'w') as filehandle:
         json.dump(coef_list, filehandle)
-    with open('fit_attr_ridge', 'w') as filehandle:
+    with open(os.path.join(config['fit_dir'], 'fit_attr_ridge'), 'w') as filehandle:
         json.dump(attr_list, filehandle)
 
     return coef_mean
 
 
-def lasso_fit(count, enrg):
+def lasso_fit(count, enrg, config=None):
     """
     Lasso fitting to energy per atom
     :param enrg: energy list
     :param count: count list containing clusters, decorations, and counts
+    :param config: fitting configuration from load_config, read from param_in if None
     :return: list of ECIs
     """
+    config = get_config(config)
     # bootstrap lasso
-    sample_size = round(sample_ratio * len(enrg))
-    coef_list = [[] for _ in range(n)]
-    attr_list = [[] for _ in range(n)]
     print('alpha, rmse, score, coef_num, cvs', flush=True)
-    for i in range(n):
-        x, y = resample(count, enrg, n_samples=sample_size, random_state=i)
-        model = LassoCV(alphas=alpha_cv, cv=kf, max_iter=1000000000, tol=coef_tol)
-        model.fit(x, y)
-        coef_list[i].append(model.intercept_)
-        coef_list[i].extend(model.coef_.tolist())
-        rmse = np.sqrt(mean_squared_error(model.predict(count), enrg))
-        score = model.score(count, enrg)
-        cvs = model.mse_path_.mean(axis=1).min()
-        coef_num = np.sum(model.coef_ != 0)
-        print(model.alpha_, rmse, score, coef_num, cvs, flush=True)
-        attr_list[i].extend([model.alpha_, rmse, score, float(coef_num), cvs])
+    if config['fit_engine'] == 'gram':
+        coef_list, attr_list = bootstrap_gram(1.0, count, enrg, config, 'lasso')
+    else:
+        model_func = functools.partial(LassoCV, alphas=config['alpha_cv'], cv=config['kf'], max_iter=1000000000,
+                                       tol=config['coef_tol'])
+        coef_list, attr_list = bootstrap(functools.partial(fit_replicate, model_func), count, enrg, config,
+                                         'lasso')
     coef_mean = np.mean(coef_list, axis=0)
     print('# of lasso selected features', np.sum(coef_mean != 0), flush=True)
-    with open('fit_coef_lasso', 'w') as filehandle:
+    with open(os.path.join(config['fit_dir'], 'fit_coef_lasso'), 'w') as filehandle:
         json.dump(coef_list, filehandle)
-    with open('fit_attr_lasso', 'w') as filehandle:
+    with open(os.path.join(config['fit_dir'], 'fit_attr_lasso'), 'w') as filehandle:
         json.dump(attr_list, filehandle)
 
     return coef_mean
 
 
-def eln_fit(count, enrg):
+def eln_fit(count, enrg, config=None):
     """
     ElasticNet fitting to energy per atom
     :param enrg: energy list
     :param count: count list containing clusters, decorations, and counts
+    :param config: fitting configuration from load_config, read from param_in if None
     :return: list of ECIs
     """
+    config = get_config(config)
     # bootstrap elasticnet
-    sample_size = round(sample_ratio * len(enrg))
-    attr_list = [[] for _ in range(n)]
-    coef_list = [[] for _ in range(n)]
     print('Eln: alpha, l1_ratio, rmse, score, coef_num', flush=True)
-    for i in range(n):
-        x, y = resample(count, enrg, n_samples=sample_size, random_state=i)
-        model = ElasticNetCV(alphas=alpha_cv, cv=kf, max_iter=1000000000, tol=coef_tol, l1_ratio=l1)
-        model.fit(x, y)
-        coef_list[i].append(model.intercept_)
-        coef_list[i].extend(model.coef_.tolist())
-        rmse = np.sqrt(mean_squared_error(model.predict(count), enrg))
-        score = model.score(count, enrg)
-        cvs = model.mse_path_.mean(axis=1).min()
-        coef_num = np.sum(model.coef_ != 0)
-        print(model.alpha_, model.l1_ratio_, rmse, score, coef_num, cvs, flush=True)
-        attr_list[i].extend([model.alpha_, model.l1_ratio_, rmse, score, float(coef_num), cvs])
+    if config['fit_engine'] == 'gram':
+        coef_list, attr_list = bootstrap_gram(config['l1'], count, enrg, config, 'eln')
+    else:
+        model_func = functools.partial(ElasticNetCV, alphas=config['alpha_cv'], cv=config['kf'], max_iter=1000000000,
+                                       tol=config['coef_tol'], l1_ratio=config['l1'])
+        coef_list, attr_list = bootstrap(functools.partial(fit_replicate, model_func), count, enrg, config,
+                                         'eln')
     coef_mean = np.mean(coef_list, axis=0)
     print('# of eln selected features', np.sum(coef_mean != 0), flush=True)
-    with open('fit_coef_eln', 'w') as filehandle:
+    with open(os.path.join(config['fit_dir'], 'fit_coef_eln'), 'w') as filehandle:
         json.dump(coef_list, filehandle)
-    with open('fit_attr_eln', 'w') as filehandle:
+    with open(os.path.join(config['fit_dir'], 'fit_attr_eln'), 'w') as filehandle:
         json.dump(attr_list, filehandle)
 
     return coef_mean
 
 
-def write_eci(name, symeq_clust_list, deco_list, eci_list, pntsym_list, spec_seq):
+_sweep_args = ()
+
+
+def _init_sweep(count, enrg, method_list):
+    """
+    keep the count matrix and energies in each sweep worker so they are only sent once at startup
+    """
+    global _sweep_args
+    _sweep_args = (count, enrg, method_list)
+
+
+def _sweep_pool(param):
+    """
+    run all fitting methods for one sweep point, with the fit log and files in its fit_dir
+    """
+    count, enrg, method_list = _sweep_args
+    config = load_config(param)
+    os.makedirs(config['fit_dir'], exist_ok=True)
+    fit_func = {'lasso': lasso_fit, 'ridge': ridge_fit, 'eln': eln_fit}
+    row_list = []
+    with open(os.path.join(config['fit_dir'], 'fit_log'), 'w') as filehandle, \
+            contextlib.redirect_stdout(filehandle):
+        for method in method_list:
+            coef_mean = fit_func[method](count, enrg, config)
+            with open(os.path.join(config['fit_dir'], 'fit_attr_' + method), 'r') as attr_file:
+                attr_list = np.array(json.load(attr_file))
+            # alpha first, rmse and cvs at the same place from the end for all methods, cvs is the lowest mean CV
+            # MSE for lasso and eln and the mean fold R2 for ridge
+            cvs = np.mean(attr_list[:, -1])
+            cv_mse, cv_r2 = (np.nan, cvs) if method == 'ridge' else (cvs, np.nan)
+            row_list.append([method, np.mean(attr_list[:, 0]), np.mean(attr_list[:, -4]), cv_mse, cv_r2,
+                             int(np.sum(coef_mean[1:] != 0))])
+    return row_list
+
+
+def sweep(count, enrg, param, grid, method_list, sweep_dir, workers=1):
+    """
+    fit every combination of the fit settings in grid on the same count matrix and energies
+    :param count: count list containing clusters, decorations, and counts
+    :param enrg: energy list
+    :param param: dictionary of the param_in options the grid is applied to
+    :param grid: dictionary of fit option names and the list of values to try, like {'kfold': [5, 10]}
+    :param method_list: fitting methods to run for each sweep point, out of 'lasso', 'ridge' and 'eln'
+    :param sweep_dir: directory for the fit files of each sweep point
+    :param workers: number of processes to spread the sweep points over, each fits its replicates serially then
+    :return: list of the sweep settings with method, mean alpha, mean rmse, mean CV MSE (lasso and eln, nan for
+             ridge), mean CV R2 (ridge, nan for lasso and eln) and number of nonzero ECIs
+    """
+    key_list = list(grid.keys())
+    point_list = [dict(zip(key_list, value)) for value in itertools.product(*[grid[key] for key in key_list])]
+    param_list = []
+    for k, point in enumerate(point_list):
+        point_param = dict(param, fit_dir=os.path.join(sweep_dir, str(k)), **point)
+        if workers > 1:
+            point_param['fit_workers'] = 1  # pool workers cannot start pools of their own
+        param_list.append(point_param)
+    _init_sweep(count, enrg, method_list)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=_init_sweep, initargs=_sweep_args)
+        result_list = pool.imap(_sweep_pool, param_list)  # keeps the sequence of the grid
+    else:
+        pool = None
+        result_list = map(_sweep_pool, param_list)
+    summary = []
+    try:
+        for k, (point, row_list) in enumerate(zip(point_list, result_list)):
+            for row in row_list:
+                summary.append([k, point] + row)
+                print(k, point, *row, flush=True)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return summary
+
+
+def build_rule(symeq_clust_list, deco_list, perm_list, spec_seq):
+    """
+    expand the decorations of every cluster into their equivalent species sequences once, so any number of eci
+    lists can be written as rule files without redoing it
+    :param symeq_clust_list: all symmetry equivalent clusters
+    :param deco_list: decoration list from count list
+    :param perm_list: all point symmetry site permutations for the given clusters
+    :param spec_seq: species order like ['Fe', 'Ni', 'Cr']
+    :return: list of [rule file text of the cluster up to 'Enrg', number of equivalent sequences of each decoration]
+    """
+    rule = []
+    for i in range(len(symeq_clust_list)):
+        text = ['\nType : ' + str(symeq_clust_list[i][0][2][0]), '\nMotif :\n']
+        for clust in symeq_clust_list[i]:
+            text.append(' : '.join(', '.join(map(str, site)) for site in clust[0]) + '\n')
+        text.append('Deco')
+        repeat = []
+        for deco in deco_list[i]:
+            spec_list = symop.find_eq_spec_list(deco, symeq_clust_list[i][0], perm_list[i][0], spec_seq)
+            text.extend(' : ' + str(spec) for spec in spec_list)
+            repeat.append(len(spec_list))
+        text.append('\nEnrg')
+        rule.append([''.join(text), repeat])
+
+    return rule
+
+
+def write_rule(name, rule, eci_list):
+    """
+    write the clusters and ecis as a rule file for the magnetic MC simulation in one write, same as write_eci
+    :param name: name of output file
+    :param rule: expanded clusters from build_rule
+    :param eci_list: eci list from fitting, the intercept first
+    """
+    eci_str = [str(eci) for eci in eci_list]
+    text = ['Motif : intercept \n', 'Enrg : ' + eci_str[0] + '\n#']
+    start = 1
+    for clust_text, repeat in rule:
+        text.append(clust_text)
+        for k in range(len(repeat)):
+            text.append((' : ' + eci_str[start + k]) * repeat[k])
+        start += len(repeat)
+        text.append('\n#')
+    with open(name, 'w') as filehandle:
+        filehandle.write(''.join(text))
+
+
+def write_eci_list(name_list, symeq_clust_list, deco_list, eci_list_all, perm_list, spec_seq):
+    """
+    write several eci lists, like all fitting methods or all bootstrap replicates, as rule files with the decorations
+    expanded only once
+    :param name_list: names of output files
+    :param symeq_clust_list: all symmetry equivalent clusters
+    :param deco_list: decoration list from count list
+    :param eci_list_all: eci lists in the same sequence as name_list
+    :param perm_list: all point symmetry site permutations for the given clusters
+    :param spec_seq: species order like ['Fe', 'Ni', 'Cr']
+    """
+    rule = build_rule(symeq_clust_list, deco_list, perm_list, spec_seq)
+    for name, eci_list in zip(name_list, eci_list_all):
+        write_rule(name, rule, eci_list)
+
+
+def write_eci(name, symeq_clust_list, deco_list, eci_list, perm_list, spec_seq):
     """
     write the clusters and ecis as a rule file for the magnetic MC simulation
     :param name: name of output file
     :param symeq_clust_list: all symmetry equivalent clusters
     :param deco_list: decoration list from count list
     :param eci_list: eci list from fitting
-    :param pntsym_list: all point symmetry operations for the given clusters
+    :param perm_list: all point symmetry site permutations for the given clusters
     :param spec_seq: species order like ['Fe', 'Ni', 'Cr']
     :return: a file like this
             #
@@ -213,37 +656,4 @@ def write_eci(name, symeq_clust_list, deco_list, eci_list, pntsym_list, spec_seq
             Deco : 0, 0, 0 : 1, 1, 1 : 0, 1, 1 : 1, 0, 0 : 2, 2, 1
             Enrg : -0.002 : 0.01 : -0.025 : -0.012 : 1.1
     """
-    output = open(name, 'w')
-    output.write('Motif : intercept \n')
-    output.write('Enrg : ' + str(eci_list[0]) + '\n#')
-    for i in range(len(symeq_clust_list)):
-        start = 0
-        for k in range(0, i):
-            start = start + len(deco_list[k])
-        # multiplicity = len(symeq_clust_list[i])
-        deco = deco_list[i]
-        spin = symeq_clust_list[i][0][2][0]
-        enrg_list = []
-        output.write('\nType : ' + str(spin))
-        output.write('\nMotif :\n')
-        for j in range(len(symeq_clust_list[i])):
-            clust = symeq_clust_list[i][j]
-            motif = clust[0]
-            size = len(motif)
-            for k in range(size-1):
-                output.write(', '.join(map(str, motif[k])) + ' : ')
-            output.write(', '.join(map(str, motif[size-1])) + '\n')
-        # output.write('\nMultiplicity : ' + str(multiplicity))
-        output.write('Deco')
-        for k in range(len(deco)):
-            spec_list = symop.find_eq_spec_list(deco[k], symeq_clust_list[i][0], pntsym_list[i][0], spec_seq)
-            enrg = [eci_list[start + k + 1]] * len(spec_list)
-            enrg_list.extend(enrg)
-            for m in range(len(spec_list)):
-                output.write(' : ' + str(spec_list[m]))
-        output.write('\nEnrg')
-        for k in range(len(enrg_list)):
-            output.write(' : ' + str(enrg_list[k]))
-        output.write('\n#')
-
-    output.close()
+    write_eci_list([name], symeq_clust_list, deco_list, [eci_list], perm_list, spec_seq)
@@ -1,7 +1,18 @@
 import math
 import copy
+import time
+import multiprocessing
 import symop
+import timing
+import hashlib
+import itertools
+import functools
+import collections
 import numpy as np
+try:
+    from numba import njit
+except ImportError:  # the compiled counting backend is optional
+    njit = None
 
 
 def apply_basis(str_list):
@@ -10,15 +21,29 @@ def apply_basis(str_list):
     :param str_list: list of structure metadata generated by parse_str function
     :return: str_list with 'LatPnt' in Cartesian coordinate
     """
-    cart_str_list = copy.deepcopy(str_list)
-    for i in range(len(str_list)):
-        str_dict = str_list[i]
-        for j in range(len(str_dict['LatPnt'])):
-            cart_str_list[i]['LatPnt'][j] = np.dot(np.transpose(str_dict['LatPnt'][j]), str_dict['LatVec'])
+    cart_str_list = []
+    for str_dict in str_list:
+        if 'CartPnt' in str_dict:  # already converted in a str_store
+            cart_pnt = str_dict['CartPnt']
+        else:
+            cart_pnt = np.matmul(np.asarray(str_dict['LatPnt'], dtype=float), np.asarray(str_dict['LatVec']))
+        cart_str_list.append(dict(str_dict, LatPnt=list(cart_pnt)))
 
     return cart_str_list
 
 
+def apply_basis_store(str_store):
+    """
+    apply lattice vector to get Cartesian coordinate for the lattice points of all structures in one go
+    :param str_store: columnar store from parse.build_str_store
+    :return: str_store with 'CartPnt' added
+    """
+    atom_str = np.repeat(np.arange(len(str_store['LatVec'])), np.diff(str_store['Offset']))
+    cart_pnt = np.matmul(str_store['LatPnt'][:, np.newaxis, :], str_store['LatVec'][atom_str])[:, 0, :]
+
+    return dict(str_store, CartPnt=cart_pnt)
+
+
 def calc_dist(pnt1, pnt2):
     """
     calculate the distance between two point in 3D Cartesian coordinate
@@ -151,80 +176,237 @@ def find_spin(clust, str_dict):
     return spin_value
 
 
-def count_singlelattice(symeq_clust_list, pntsym_list, str_list, clust_list):
+def build_site_index(str_dict, cell=0.2):
     """
-    count the number of each cluster for each structure with single lattice
+    build a hash grid of the atoms in a structure so that each site lookup only checks the neighboring grid cells
+    :param str_dict: containing Cartesian coordinates
+    :param cell: edge of the grid cells, not smaller than the distance tolerance of the site lookup
+    :return: site_index: dictionary with the atoms sorted by grid cell
+    """
+    lat_pnt = np.array(str_dict['LatPnt'], dtype=float).reshape(-1, 3)
+    grid = np.floor(lat_pnt / cell).astype(int)
+    grid_min = grid.min(axis=0) - 1
+    grid_dim = grid.max(axis=0) - grid_min + 2
+    key = np.ravel_multi_index((grid - grid_min).T, grid_dim)
+    order = np.argsort(key, kind='stable')  # atoms in the same cell stay in the input sequence
+    occ = np.max(np.unique(key, return_counts=True)[1])
+    site_index = {'LatPnt': lat_pnt, 'Spec': list(str_dict['Spec']), 'Spin': np.array(str_dict['Spin'], dtype=float),
+                  'Cell': cell, 'GridMin': grid_min, 'GridDim': grid_dim, 'Key': key[order], 'Order': order,
+                  'Occ': occ}
+
+    return site_index
+
+
+def find_site(coords, site_index, tol=0.2):
+    """
+    find the atom on each of the given sites, same as the linear search in find_spec: the closest atom within an
+    L1 distance of tol, the first one in the structure if more than one
+    :param coords: array of wrapped Cartesian coordinates in the shape of (N, 3)
+    :param site_index: hash grid from build_site_index
+    :param tol: L1 distance tolerance, not larger than the grid cell
+    :return: array of atom indices in the shape of (N,), -1 where no atom is found
+    """
+    coords = np.asarray(coords, dtype=float).reshape(-1, 3)
+    grid = np.floor(coords / site_index['Cell']).astype(int) - site_index['GridMin']
+    shift = np.array([[x, y, z] for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)])
+    grid = grid[:, np.newaxis, :] + shift[np.newaxis, :, :]  # (N, 27, 3) neighboring cells
+    valid = np.all((grid >= 0) & (grid < site_index['GridDim']), axis=2)
+    key = np.ravel_multi_index(np.moveaxis(np.where(valid[..., np.newaxis], grid, 0), 2, 0), site_index['GridDim'])
+    start = np.searchsorted(site_index['Key'], key)
+    cand = []
+    for occ in range(site_index['Occ']):
+        pos = np.minimum(start + occ, len(site_index['Key']) - 1)
+        hit = valid & (start + occ < len(site_index['Key'])) & (site_index['Key'][pos] == key)
+        cand.append(np.where(hit, site_index['Order'][pos], -1))
+    cand = np.concatenate(cand, axis=1)
+    dist = np.sum(np.abs(coords[:, np.newaxis, :] - site_index['LatPnt'][cand]), axis=2)
+    dist[cand < 0] = np.inf
+    min_dist = np.min(dist, axis=1)
+    site = np.min(np.where(dist == min_dist[:, np.newaxis], cand, len(site_index['LatPnt'])), axis=1)
+    site[~(min_dist < tol)] = -1
+
+    return site
+
+
+def find_spec_spin(clust, site_index):
+    """
+    find the species on each sites of a given cluster and the spin product of all sites in one lookup
+    :param clust: containing Cartesian coordinate after applying PBC
+    :param site_index: hash grid of the structure from build_site_index
+    :return: spec_list: a list of species in the same sequence of the cluster sites, spin product of all sites
+    """
+    site = find_site(clust[0], site_index)
+    if np.any(site < 0):
+        return ['empty'], 0
+    spec_list = [site_index['Spec'][j] for j in site]
+    spin_value = math.prod(site_index['Spin'][site])
+
+    return spec_list, spin_value
+
+
+def count_str(str_dict, symeq_clust_list, perm_list, clust_list, deco_table_list=None):
+    """
+    count the number of each cluster for a single structure with single lattice
+    :param str_dict: structure metadata from parse_str function in direct coordinate
     :param symeq_clust_list: list of symmetry operation based on the input lattice file defined like ATAT
-    :param pntsym_list: list of point symmetry operation for each symmetry equivalent cluster
-    :param str_list: parsed DFT data list
+    :param perm_list: list of point symmetry site permutations for each symmetry equivalent cluster
     :param clust_list: parsed cluster list
-    :return: list of the count number (count_list)
+    :param deco_table_list: decoration tables from symop.build_deco_table_list, None to apply perm_list directly
+    :return: count list of the structure, flag of empty clusters
+    """
+    str_dict = apply_basis([str_dict])[0]  # transform str from direct coord to Cartesian coord
+    vac_flag = False
+    site_index = build_site_index(str_dict)
+    count_list = copy.deepcopy(clust_list)
+    for i in range(len(clust_list)):
+        clust_start = time.perf_counter()
+        count_dict = {}
+        orig_clust = apply_pbc(clust_list[i], str_dict)  # apply PBCs
+        # spec = find_spec(orig_clust, str_dict)
+        # if spec == ['empty']:
+        #     print('Cluster #', i + 1, 'is not present in Structure', str_dict['CellName'])
+        #     print('Check your input file carefully!')
+        # else:
+        symeq_clust = symeq_clust_list[i]
+        multiplicity = len(symeq_clust)
+        count_list[i].append({'Multiplicity': int(multiplicity/len(orig_clust[0]))})
+        for j in range(len(str_dict['LatPnt'])):
+            for k in range(multiplicity):
+                old_clust = symeq_clust[k]
+                vect = np.subtract.reduce([str_dict['LatPnt'][j], [0, 0, 0]], axis=0)
+                new_clust = copy.deepcopy(old_clust)
+                for x in range(len(old_clust[0])):
+                    new_clust[0][x] = np.sum([old_clust[0][x], vect], axis=0)
+                pbc_clust = apply_pbc(new_clust, str_dict)
+                spec, spin = find_spec_spin(pbc_clust, site_index)
+                if spec == ['empty']:
+                    vac_flag = True
+                if spec != ['empty']:
+                    # find the only true equivalent sequence
+                    if deco_table_list is None:
+                        spec = symop.find_eq_spec_seq(list(spec), old_clust, perm_list[i][k])
+                    else:
+                        spec = symop.find_deco(deco_table_list[i][k], spec, old_clust, perm_list[i][k])
+                    if pbc_clust[2][0] == 0:  # chem term
+                        if str(spec) in count_dict.keys():
+                            count_dict[str(spec)] += 1
+                        else:
+                            count_dict[str(spec)] = 1
+                    elif pbc_clust[2][0] == 1:  # spin term
+                        if str(spec) in count_dict.keys():
+                            # if len(pbc_clust[1]) == 1:
+                            #     count_dict[str(spec)] += abs(spin)
+                            # else:
+                            #     count_dict[str(spec)] += spin
+                            count_dict[str(spec)] += spin
+                        else:
+                            # if len(pbc_clust[1]) == 1:
+                            #     count_dict[str(spec)] = abs(spin)
+                            # else:
+                            #     count_dict[str(spec)] = spin
+                            count_dict[str(spec)] = spin
+        for keys in count_dict:
+            values = count_dict[keys]
+            count_dict[keys] = np.around(values/(str_dict['AtomSum']*len(orig_clust[0])), decimals=5)
+        count_list[i].append(count_dict)
+        timing.add_clust(i, time.perf_counter() - clust_start)
+
+    return count_list, vac_flag
+
+
+_pool_args = ()
+
+
+def _init_pool(count_func, symeq_clust_list, perm_list, clust_list, deco_table_list):
     """
+    keep the clusters, site permutations and decoration tables in each worker so they are only sent once at startup
+    """
+    global _pool_args
+    _pool_args = (count_func, symeq_clust_list, perm_list, clust_list, deco_table_list)
+
+
+def _count_pool(str_dict):
+    """
+    count a single structure in a worker with the clusters from _init_pool
+    """
+    count_func, symeq_clust_list, perm_list, clust_list, deco_table_list = _pool_args
+    return (str_dict['CellName'],) + tuple(count_func(str_dict, symeq_clust_list, perm_list, clust_list,
+                                                      deco_table_list))
+
+
+def count_all(count_func, symeq_clust_list, perm_list, str_list, clust_list, workers=1, spin_pair=False,
+              deco_table=True):
+    """
+    count the number of each cluster for each structure with a single structure counting function
+    :param count_func: count_str or count_str_vector
+    :param symeq_clust_list: list of symmetry operation based on the input lattice file defined like ATAT
+    :param perm_list: list of point symmetry site permutations for each symmetry equivalent cluster
+    :param str_list: parsed DFT data list, or a generator like parse.iter_str so structures are counted as they come
+    :param clust_list: parsed cluster list
+    :param workers: number of processes to spread the structures over
+    :param spin_pair: also sum the spin product histograms of count_func over all structures, count_str_vector only
+    :param deco_table: build the decoration tables for count_func, False for count_str_jit which does not use them
+    :return: list of the count number (count_list) in the same sequence as str_list, and the spin pair count list in
+             the format of count_spin_pair if spin_pair
+    """
+    if spin_pair:
+        count_func = functools.partial(count_func, spin_pair=True)
+    if isinstance(str_list, list):
+        spec_seq = sorted(set(spec for str_dict in str_list for spec in str_dict['Spec']))
+        chunk = max(1, len(str_list) // (4 * max(workers, 1)))
+    else:
+        spec_seq = []  # decoration tables are filled as new species show up
+        chunk = 16
+    deco_table_list = symop.build_deco_table_list(symeq_clust_list, perm_list, spec_seq) if deco_table else None
+    _init_pool(count_func, symeq_clust_list, perm_list, clust_list, deco_table_list)
     count_list_all = []
-    str_list = apply_basis(str_list)  # transform str from direct coord to Cartesian coord
-    for str_dict in str_list:
-        vac_flag = False
-        count_list = copy.deepcopy(clust_list)
-        for i in range(len(clust_list)):
-            count_dict = {}
-            orig_clust = apply_pbc(clust_list[i], str_dict)  # apply PBCs
-            # spec = find_spec(orig_clust, str_dict)
-            # if spec == ['empty']:
-            #     print('Cluster #', i + 1, 'is not present in Structure', str_dict['CellName'])
-            #     print('Check your input file carefully!')
-            # else:
-            symeq_clust = symeq_clust_list[i]
-            multiplicity = len(symeq_clust)
-            count_list[i].append({'Multiplicity': int(multiplicity/len(orig_clust[0]))})
-            for j in range(len(str_dict['LatPnt'])):
-                for k in range(multiplicity):
-                    old_clust = symeq_clust[k]
-                    vect = np.subtract.reduce([str_dict['LatPnt'][j], [0, 0, 0]], axis=0)
-                    new_clust = copy.deepcopy(old_clust)
-                    for x in range(len(old_clust[0])):
-                        new_clust[0][x] = np.sum([old_clust[0][x], vect], axis=0)
-                    pbc_clust = apply_pbc(new_clust, str_dict)
-                    spec = find_spec(pbc_clust, str_dict)
-                    if spec == ['empty']:
-                        vac_flag = True
-                    if spec != ['empty']:
-                        # find the only true equivalent sequence
-                        spec = symop.find_eq_spec_seq(list(spec), old_clust, pntsym_list[i][k])
-                        if pbc_clust[2][0] == 0:  # chem term
-                            if str(spec) in count_dict.keys():
-                                count_dict[str(spec)] += 1
-                            else:
-                                count_dict[str(spec)] = 1
-                        elif pbc_clust[2][0] == 1:  # spin term
-                            spin = find_spin(pbc_clust, str_dict)
-                            if str(spec) in count_dict.keys():
-                                # if len(pbc_clust[1]) == 1:
-                                #     count_dict[str(spec)] += abs(spin)
-                                # else:
-                                #     count_dict[str(spec)] += spin
-                                count_dict[str(spec)] += spin
-                            else:
-                                # if len(pbc_clust[1]) == 1:
-                                #     count_dict[str(spec)] = abs(spin)
-                                # else:
-                                #     count_dict[str(spec)] = spin
-                                count_dict[str(spec)] = spin
-            for keys in count_dict:
-                values = count_dict[keys]
-                count_dict[keys] = np.around(values/(str_dict['AtomSum']*len(orig_clust[0])), decimals=5)
-            count_list[i].append(count_dict)
-        count_list_all.append([str_dict['CellName'], count_list])
-        if vac_flag:
-            print('Empty cluster in Structure', str_dict['CellName'], "! Check input if you don't expect vacancy!")
+    count_spin_list = []
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initializer=_init_pool, initargs=_pool_args)
+        result_list = pool.imap(_count_pool, str_list, chunksize=chunk)  # keeps the sequence of str_list
+    else:
+        pool = None
+        result_list = map(_count_pool, str_list)
+    try:
+        for cell_name, count_list, vac_flag, *spin_pair_list in result_list:
+            count_list_all.append([cell_name, count_list])
+            if vac_flag:
+                print('Empty cluster in Structure', cell_name, "! Check input if you don't expect vacancy!")
+            if spin_pair:
+                if not count_spin_list:
+                    count_spin_list = [[i, {}] for i, count_dict in spin_pair_list[0]]
+                for k, (i, count_dict) in enumerate(spin_pair_list[0]):
+                    total_dict = count_spin_list[k][1]
+                    for deco, hist in count_dict.items():
+                        total_dict[deco] = [x + y for x, y in zip(total_dict.get(deco, [0, 0, 0]), hist)]
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
+    if spin_pair:
+        return count_list_all, count_spin_list
     return count_list_all
 
 
-def count_spin_pair(symeq_clust_list, pntsym_list, str_list, clust_list):
+def count_singlelattice(symeq_clust_list, perm_list, str_list, clust_list, workers=1):
+    """
+    count the number of each cluster for each structure with single lattice
+    :param symeq_clust_list: list of symmetry operation based on the input lattice file defined like ATAT
+    :param perm_list: list of point symmetry site permutations for each symmetry equivalent cluster
+    :param str_list: parsed DFT data list
+    :param clust_list: parsed cluster list
+    :param workers: number of processes to spread the structures over
+    :return: list of the count number (count_list)
+    """
+    return count_all(count_str, symeq_clust_list, perm_list, str_list, clust_list, workers)
+
+
+def count_spin_pair(symeq_clust_list, perm_list, str_list, clust_list):
     """
     count the number of each cluster for each structure with single lattice
     :param symeq_clust_list: list of symmetry operation based on the input lattice file defined like ATAT
-    :param pntsym_list: list of point symmetry operation for each symmetry equivalent cluster
+    :param perm_list: list of point symmetry site permutations for each symmetry equivalent cluster
     :param str_list: parsed DFT data list
     :param clust_list: parsed cluster list
     :return: list of the count number (count_list)
@@ -235,6 +417,7 @@ def count_spin_pair(symeq_clust_list, pntsym_list, str_list, clust_list):
         if clust_list[i][2][0] == 1:
             count_dict = {}
             for str_dict in str_list:
+                site_index = build_site_index(str_dict)
                 symeq_clust = symeq_clust_list[i]
                 multiplicity = len(symeq_clust)
                 for j in range(len(str_dict['LatPnt'])):
@@ -245,15 +428,367 @@ def count_spin_pair(symeq_clust_list, pntsym_list, str_list, clust_list):
                         for x in range(len(old_clust[0])):
                             new_clust[0][x] = np.sum([old_clust[0][x], vect], axis=0)
                         pbc_clust = apply_pbc(new_clust, str_dict)
-                        spec = find_spec(pbc_clust, str_dict)
+                        spec, spin = find_spec_spin(pbc_clust, site_index)
                         if spec != ['empty']:
-                            spec = symop.find_eq_spec_seq(list(spec), old_clust, pntsym_list[i][k])
-                            spin = find_spin(pbc_clust, str_dict)
+                            spec = symop.find_eq_spec_seq(list(spec), old_clust, perm_list[i][k])
                             if str(spec) in count_dict.keys():
-                                count_dict[str(spec)][int(spin+1)] += 1
+                                count_dict[str(spec)][int(np.sign(spin) + 1)] += 1
                             else:
                                 count_dict[str(spec)] = [0, 0, 0]
-                                count_dict[str(spec)][int(spin + 1)] = 1
+                                count_dict[str(spec)][int(np.sign(spin) + 1)] = 1
             count_list_all.append([i, count_dict])
 
     return count_list_all
+
+
+def wrap_coords(coords, basis):
+    """
+    Apply periodic boundary conditions to an array of sites at once, same as apply_pbc site by site
+    :param coords: array of Cartesian coordinates in the shape of (N, 3)
+    :param basis: list in the format of [[0.0, 0.0, 3.6], [0.0, 3.6, 0.0], [3.6, 0.0, 0.0]]
+    :return: array of wrapped Cartesian coordinates in the shape of (N, 3)
+    """
+    trans_matr = np.vstack(basis).T
+    inv_matr = np.linalg.inv(trans_matr)
+    frac_coords = np.around(np.matmul(inv_matr, coords.T).T, decimals=3) % 1
+
+    return np.matmul(trans_matr, frac_coords.T).T
+
+
+_placement_cache = collections.OrderedDict()  # placement tables of the recently counted lattices, oldest first
+
+
+def get_placement(key):
+    """
+    look up a placement table in the least recently used cache
+    :param key: lattice and cluster key of the table
+    :return: array of atom indices in the shape of (placement, site), None if not cached
+    """
+    site = _placement_cache.get(key)
+    if site is not None:
+        _placement_cache.move_to_end(key)
+
+    return site
+
+
+def put_placement(key, site, cache_size):
+    """
+    add a placement table to the least recently used cache and remove the oldest tables above the size limit
+    :param key: lattice and cluster key of the table
+    :param site: array of atom indices in the shape of (placement, site)
+    :param cache_size: maximum size of the cached tables in MB
+    """
+    site.flags.writeable = False  # shared by all structures on the same lattice
+    _placement_cache[key] = site
+    total = sum(table.nbytes for table in _placement_cache.values())
+    while total > cache_size * 1e6 and len(_placement_cache) > 1:
+        total -= _placement_cache.popitem(last=False)[1].nbytes
+
+
+def count_str_vector(str_dict, symeq_clust_list, perm_list, clust_list, deco_table_list=None, spin_pair=False,
+                     cache_size=None):
+    """
+    count the number of each cluster for a single structure, placing all symmetry equivalent clusters on all
+    lattice points as whole arrays, once for all clusters with the same sites like the chem and spin terms of a pair
+    :param str_dict: structure metadata from parse_str function in direct coordinate
+    :param symeq_clust_list: list of symmetry operation based on the input lattice file defined like ATAT
+    :param perm_list: list of point symmetry site permutations for each symmetry equivalent cluster
+    :param clust_list: parsed cluster list
+    :param deco_table_list: decoration tables from symop.build_deco_table_list, None to apply perm_list directly
+    :param spin_pair: also return the spin product histograms of the spin terms like count_spin_pair
+    :param cache_size: maximum size in MB of the placement tables kept for structures with the same lattice vectors
+                       and sites, which then only gather their species and spins through the tables, None to disable
+    :return: count list of the structure in the same format as count_singlelattice, flag of empty clusters, and the
+             list of [cluster index, {decoration: [negative, zero, positive spin product counts]}] of the spin
+             terms if spin_pair
+    """
+    vac_flag = False
+    if 'CartPnt' in str_dict:  # already converted in a str_store
+        lat_pnt = np.asarray(str_dict['CartPnt'], dtype=float)
+    else:
+        lat_pnt = np.matmul(np.array(str_dict['LatPnt'], dtype=float), np.array(str_dict['LatVec'], dtype=float))
+    lat_pnt = np.ascontiguousarray(lat_pnt, dtype=float).reshape(-1, 3)
+    lat_key = hashlib.sha1(lat_pnt.tobytes() + np.array(str_dict['LatVec'], dtype=float).tobytes()).hexdigest()
+    site_index = None  # only needed for the placement tables that are not cached
+    spec_name, spec_code = np.unique(str_dict['Spec'], return_inverse=True)
+    spin = np.array(str_dict['Spin'], dtype=float)
+    count_list = copy.deepcopy(clust_list)
+    spin_pair_dict = {}
+    group_dict = {}  # clusters with the same symmetry equivalent sites and permutations
+    for i in range(len(clust_list)):
+        motif = np.array([clust[0] for clust in symeq_clust_list[i]], dtype=float)
+        perm = [None if order is None else np.asarray(order, dtype=np.int64) for order in perm_list[i]]
+        perm = tuple(None if order is None else (order.shape, order.tobytes()) for order in perm)
+        group_dict.setdefault((motif.shape, motif.tobytes(), perm), []).append(i)
+    for group in group_dict.values():
+        group_start = time.perf_counter()
+        symeq_clust = symeq_clust_list[group[0]]
+        multiplicity = len(symeq_clust)
+        size = len(clust_list[group[0]][0])
+        for i in group:
+            count_list[i].append({'Multiplicity': int(multiplicity/size)})
+        # all sites of all symmetry equivalent clusters on all lattice points, in the shape of (placement, site, 3)
+        motif = np.array([clust[0] for clust in symeq_clust], dtype=float)
+        pnt_idx, clust_idx = np.divmod(np.arange(len(lat_pnt) * multiplicity), multiplicity)
+        key = (lat_key, motif.shape, motif.tobytes())
+        site = get_placement(key) if cache_size else None
+        if site is None:
+            if site_index is None:
+                site_index = build_site_index(dict(str_dict, LatPnt=lat_pnt))
+            coords = lat_pnt[pnt_idx, np.newaxis, :] + motif[clust_idx]
+            site = find_site(wrap_coords(coords.reshape(-1, 3), str_dict['LatVec']), site_index)
+            site = site.reshape(-1, size)  # one row per cluster placement, in the same sequence as count_singlelattice
+            if cache_size:
+                put_placement(key, site, cache_size)
+        full = np.all(site >= 0, axis=1)
+        if not np.all(full):
+            vac_flag = True
+        site = site[full]
+        clust_idx = clust_idx[full]
+        if len(site) == 0:
+            for i in group:
+                count_list[i].append({})
+                if clust_list[i][2][0] == 1:
+                    spin_pair_dict[i] = {}
+                timing.add_clust(i, (time.perf_counter() - group_start) / len(group))
+            continue
+        # find the only true equivalent sequence once for each distinct (cluster, decoration) pair
+        i = group[0]
+        seq_list, seq_idx = np.unique(np.column_stack([clust_idx, spec_code[site]]), axis=0, return_inverse=True)
+        seq_deco = []
+        for seq in seq_list:
+            spec = [str(spec_name[x]) for x in seq[1:]]
+            if deco_table_list is None:
+                seq_deco.append(symop.find_eq_spec_seq(spec, symeq_clust[seq[0]], perm_list[i][seq[0]]))
+            else:
+                seq_deco.append(symop.find_deco(deco_table_list[i][seq[0]], spec, symeq_clust[seq[0]],
+                                                perm_list[i][seq[0]]))
+        deco_list, deco_idx = np.unique(seq_deco, return_inverse=True)
+        deco_idx = deco_idx[seq_idx.reshape(-1)]
+        first = np.unique(deco_idx, return_index=True)[1]  # first placement of each decoration
+        spin_prod = None
+        shared = (time.perf_counter() - group_start) / len(group)  # placement and lookup split over the members
+        for i in group:
+            clust_start = time.perf_counter()
+            count_dict = {}
+            if clust_list[i][2][0] == 0:  # chem term
+                values = np.bincount(deco_idx, minlength=len(deco_list)).tolist()
+            elif clust_list[i][2][0] == 1:  # spin term
+                if spin_prod is None:
+                    spin_prod = np.prod(spin[site], axis=1)
+                values = spin_prod[first]
+                rest = np.ones(len(deco_idx), dtype=bool)
+                rest[first] = False
+                np.add.at(values, deco_idx[rest], spin_prod[rest])  # accumulate in placement sequence
+            else:  # other cluster types are not counted, like count_str
+                values = None
+            if values is not None:
+                for k in np.argsort(first):
+                    count_dict[str(deco_list[k])] = np.around(values[k]/(str_dict['AtomSum']*size), decimals=5)
+            count_list[i].append(count_dict)
+            if spin_pair and clust_list[i][2][0] == 1:
+                hist = np.zeros((len(deco_list), 3), dtype=int)
+                np.add.at(hist, (deco_idx, np.sign(spin_prod).astype(int) + 1), 1)  # same bins as +-1 spins
+                spin_pair_dict[i] = {str(deco_list[k]): hist[k].tolist() for k in np.argsort(first)}
+            timing.add_clust(i, shared + time.perf_counter() - clust_start)
+
+    if spin_pair:
+        return count_list, vac_flag, [[i, spin_pair_dict[i]] for i in sorted(spin_pair_dict)]
+    return count_list, vac_flag
+
+
+def count_vector(symeq_clust_list, perm_list, str_list, clust_list, workers=1, spin_pair=False, cache_size=None):
+    """
+    count the number of each cluster for each structure with single lattice, one structure as whole arrays at a time
+    :param symeq_clust_list: list of symmetry operation based on the input lattice file defined like ATAT
+    :param perm_list: list of point symmetry site permutations for each symmetry equivalent cluster
+    :param str_list: parsed DFT data list
+    :param clust_list: parsed cluster list
+    :param workers: number of processes to spread the structures over
+    :param spin_pair: also count the spin pairs like count_spin_pair in the same pass
+    :param cache_size: maximum size in MB of the placement tables kept in each process, None to disable
+    :return: list of the count number (count_list), same as count_singlelattice, and the spin pair count list if
+             spin_pair
+    """
+    count_func = functools.partial(count_str_vector, cache_size=cache_size)
+    return count_all(count_func, symeq_clust_list, perm_list, str_list, clust_list, workers, spin_pair)
+
+
+def _count_kernel(lat_pnt, lat_vec, spec_code, spin, motif, perm, spec_num, term, grid_key, grid_order, grid_min,
+                  grid_dim, cell, tol=0.2):
+    """
+    place all symmetry equivalent clusters of one cluster on all lattice points of a structure and accumulate the
+    counts by decoration, compiled with numba when it is installed
+    :param lat_pnt: Cartesian coordinates of the atoms in the shape of (N, 3)
+    :param lat_vec: lattice vectors in the shape of (3, 3)
+    :param spec_code: species code of each atom in the sorted species order in the shape of (N,)
+    :param spin: spin of each atom in the shape of (N,)
+    :param motif: site coordinates of the symmetry equivalent clusters in the shape of (M, S, 3)
+    :param perm: site permutations of each symmetry equivalent cluster in the shape of (M, P, S)
+    :param spec_num: number of species codes
+    :param term: 0 for chem term, 1 for spin term
+    :param grid_key: sorted grid cell keys of the atoms, 'Key' of build_site_index
+    :param grid_order: atom indices in the sequence of grid_key, 'Order' of build_site_index
+    :param grid_min: grid cell offset in the shape of (3,), 'GridMin' of build_site_index
+    :param grid_dim: grid size in the shape of (3,), 'GridDim' of build_site_index
+    :param cell: edge of the grid cells, 'Cell' of build_site_index
+    :param tol: L1 distance tolerance of the site lookup, not larger than cell
+    :return: count vector indexed by the canonical decoration code, index of the first placement of each code (-1
+             if not counted), flag of empty clusters
+    """
+    trans_matr = lat_vec.T.copy()
+    inv_matr = np.linalg.inv(trans_matr)
+    pnt_num = lat_pnt.shape[0]
+    clust_num = motif.shape[0]
+    size = motif.shape[1]
+    values = np.zeros(spec_num ** size)
+    first = -np.ones(spec_num ** size, dtype=np.int64)
+    vac_flag = False
+    site = np.zeros(size, dtype=np.int64)
+    frac = np.zeros(3)
+    cart = np.zeros(3)
+    grid = np.zeros(3, dtype=np.int64)
+    key_num = grid_key.shape[0]
+    for j in range(pnt_num):
+        for k in range(clust_num):
+            full = True
+            for x in range(size):
+                for a in range(3):  # apply PBCs like wrap_coords
+                    frac[a] = 0.0
+                    for b in range(3):
+                        frac[a] += inv_matr[a, b] * (lat_pnt[j, b] + motif[k, x, b])
+                    frac[a] = (np.rint(frac[a] * 1000.0) / 1000.0) % 1.0
+                for a in range(3):
+                    cart[a] = 0.0
+                    for b in range(3):
+                        cart[a] += trans_matr[a, b] * frac[b]
+                for a in range(3):
+                    grid[a] = int(np.floor(cart[a] / cell)) - grid_min[a]
+                dist = tol
+                site[x] = -1
+                for dx in range(-1, 2):  # closest atom in the neighboring grid cells, the first one if more than one
+                    for dy in range(-1, 2):  # like find_site
+                        for dz in range(-1, 2):
+                            gx, gy, gz = grid[0] + dx, grid[1] + dy, grid[2] + dz
+                            if gx < 0 or gy < 0 or gz < 0 or gx >= grid_dim[0] or gy >= grid_dim[1] or \
+                                    gz >= grid_dim[2]:
+                                continue
+                            key = (gx * grid_dim[1] + gy) * grid_dim[2] + gz
+                            m = np.searchsorted(grid_key, key)
+                            while m < key_num and grid_key[m] == key:
+                                n = grid_order[m]
+                                new_dist = abs(cart[0] - lat_pnt[n, 0]) + abs(cart[1] - lat_pnt[n, 1]) + \
+                                    abs(cart[2] - lat_pnt[n, 2])
+                                if new_dist < dist or (new_dist == dist and 0 <= n < site[x]):
+                                    dist = new_dist
+                                    site[x] = n
+                                m += 1
+                if site[x] < 0:
+                    full = False
+                    break
+            if not full:
+                vac_flag = True
+                continue
+            # the smallest permuted code is the only true equivalent sequence of find_eq_spec_seq
+            code = -1
+            for p in range(perm.shape[1]):
+                new_code = 0
+                for x in range(size):
+                    new_code = new_code * spec_num + spec_code[site[perm[k, p, x]]]
+                if code < 0 or new_code < code:
+                    code = new_code
+            if term == 0:  # chem term
+                value = 1.0
+            elif term == 1:  # spin term
+                value = 1.0
+                for x in range(size):
+                    value *= spin[site[x]]
+            else:
+                continue
+            if first[code] < 0:  # start from the first value like count_str, keeping the sign of a zero product
+                values[code] = value
+                first[code] = j * clust_num + k
+            else:
+                values[code] += value
+
+    return values, first, vac_flag
+
+
+if njit is not None:
+    _count_kernel = njit(cache=True)(_count_kernel)
+
+
+def build_kernel_clust(symeq_clust, perm):
+    """
+    flatten the symmetry equivalent clusters of one cluster into the arrays taken by _count_kernel
+    :param symeq_clust: symmetry equivalent clusters from symeq_clust_list
+    :param perm: point symmetry site permutations for each symmetry equivalent cluster
+    :return: site coordinates in the shape of (M, S, 3), site permutations in the shape of (M, P, S)
+    """
+    motif = np.array([clust[0] for clust in symeq_clust], dtype=float)
+    size = motif.shape[1]
+    if size >= 3:
+        perm_list = [list(order) for order in perm]
+    else:  # find_eq_spec_seq sorts pairs and keeps points
+        perm_list = [list(itertools.permutations(range(size)))] * len(symeq_clust)
+    perm_num = max(len(order_list) for order_list in perm_list)
+    perm_table = np.array([order_list + [order_list[0]] * (perm_num - len(order_list)) for order_list in perm_list],
+                          dtype=np.int64)
+
+    return motif, perm_table
+
+
+def count_str_jit(str_dict, symeq_clust_list, perm_list, clust_list, deco_table_list=None):
+    """
+    count the number of each cluster for a single structure with the compiled placement kernel
+    :param str_dict: structure metadata from parse_str function in direct coordinate
+    :param symeq_clust_list: list of symmetry operation based on the input lattice file defined like ATAT
+    :param perm_list: list of point symmetry site permutations for each symmetry equivalent cluster
+    :param clust_list: parsed cluster list
+    :param deco_table_list: not used, the kernel finds the equivalent sequences from perm_list
+    :return: count list of the structure in the same format as count_singlelattice, flag of empty clusters
+    """
+    vac_flag = False
+    if 'CartPnt' in str_dict:  # already converted in a str_store
+        lat_pnt = np.asarray(str_dict['CartPnt'], dtype=float)
+    else:
+        lat_pnt = np.matmul(np.array(str_dict['LatPnt'], dtype=float), np.array(str_dict['LatVec'], dtype=float))
+    lat_pnt = np.ascontiguousarray(lat_pnt.reshape(-1, 3))
+    lat_vec = np.array(str_dict['LatVec'], dtype=float)
+    spec_name, spec_code = np.unique(str_dict['Spec'], return_inverse=True)
+    spin = np.array(str_dict['Spin'], dtype=float)
+    site_index = build_site_index(dict(str_dict, LatPnt=lat_pnt))
+    grid_index = (site_index['Key'].astype(np.int64), site_index['Order'].astype(np.int64),
+                  site_index['GridMin'].astype(np.int64), site_index['GridDim'].astype(np.int64), site_index['Cell'])
+    count_list = copy.deepcopy(clust_list)
+    for i in range(len(clust_list)):
+        clust_start = time.perf_counter()
+        count_dict = {}
+        size = len(clust_list[i][0])
+        count_list[i].append({'Multiplicity': int(len(symeq_clust_list[i])/size)})
+        motif, perm = build_kernel_clust(symeq_clust_list[i], perm_list[i])
+        values, first, empty = _count_kernel(lat_pnt, lat_vec, spec_code.astype(np.int64), spin, motif, perm,
+                                             len(spec_name), clust_list[i][2][0], *grid_index)
+        vac_flag = vac_flag or empty
+        code_list = np.flatnonzero(first >= 0)
+        for code in code_list[np.argsort(first[code_list])]:  # in the sequence of the first placement
+            spec = np.unravel_index(code, (len(spec_name),) * size)
+            deco = ', '.join(str(spec_name[x]) for x in spec)
+            count_dict[deco] = np.around(values[code]/(str_dict['AtomSum']*size), decimals=5)
+        count_list[i].append(count_dict)
+        timing.add_clust(i, time.perf_counter() - clust_start)
+
+    return count_list, bool(vac_flag)
+
+
+def count_jit(symeq_clust_list, perm_list, str_list, clust_list, workers=1):
+    """
+    count the number of each cluster for each structure with single lattice with the compiled placement kernel
+    :param symeq_clust_list: list of symmetry operation based on the input lattice file defined like ATAT
+    :param perm_list: list of point symmetry site permutations for each symmetry equivalent cluster
+    :param str_list: parsed DFT data list
+    :param clust_list: parsed cluster list
+    :param workers: number of processes to spread the structures over
+    :return: list of the count number (count_list), same as count_singlelattice
+    """
+    return count_all(count_str_jit, symeq_clust_list, perm_list, str_list, clust_list, workers, deco_table=False)
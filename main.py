@@ -2,151 +2,208 @@ import parse
 import count
 import symop
 import cefit
-from pymatgen.core import Molecule
-from pymatgen.symmetry import analyzer as syman
+import cache
+import pipeline
+import timing
 import json
 import time
+import cProfile
+import functools
 import yaml
 
 
-start_time = time.time()
-with open('param_in', 'r') as filehandle:
-    param = yaml.safe_load(filehandle)
-# to-do: write functions to read in params after setting the default values
-# keys = ['do_count', 'do_fit', 'use_avg_enrg']
-# for key in keys:
-#     for k, v in param.items():
-#         if key in k:
-#             print(v)
-do_count = param['do_count']
-do_fit = param['do_fit']
-use_avg = param['use_avg_enrg']
-rescale_enrg = param['rescale_enrg']
-ep_comp = param['ep_comp']
-ep_enrg = param['ep_enrg']
-fit_lasso = param['fit_lasso']
-fit_ridge = param['fit_ridge']
-fit_eln = param['fit_eln']
-lat_in = param['lat_in']
-data_file = param['data_file']
-clust_in = param['clust_in']
-species = param['species']
+if __name__ == '__main__':  # count workers re-import this module on spawn
+    start_time = time.time()
+    with open('param_in', 'r') as filehandle:
+        param = yaml.safe_load(filehandle)
+    # to-do: write functions to read in params after setting the default values
+    # keys = ['do_count', 'do_fit', 'use_avg_enrg']
+    # for key in keys:
+    #     for k, v in param.items():
+    #         if key in k:
+    #             print(v)
+    do_count = param['do_count']
+    do_fit = param['do_fit']
+    use_avg = param.get('use_avg_enrg', False)
+    rescale_enrg = param['rescale_enrg']
+    ep_comp = param['ep_comp']
+    ep_enrg = param['ep_enrg']
+    fit_lasso = param['fit_lasso']
+    fit_ridge = param['fit_ridge']
+    fit_eln = param['fit_eln']
+    lat_in = param['lat_in']
+    data_file = param['data_file']
+    clust_in = param['clust_in']
+    species = param['species']
+    count_engine = param.get('count_engine', 'loop')
+    count_backend = param.get('count_backend', 'python')
+    count_workers = int(param.get('count_workers', 1))
+    count_spin_out = param.get('count_spin_out', None)
+    placement_cache_size = param.get('placement_cache_size', None)
+    rule_replicates = param.get('rule_replicates', False)
+    count_cache = param.get('count_cache', None)
+    count_cache_size = param.get('count_cache_size', None)
+    dedup_decimals = param.get('dedup_decimals', None)
+    sym_cache = param.get('sym_cache', None)
+    sym_out = param.get('sym_out', None)
+    out_format = param.get('out_format', 'json')
+    sparse_count = param.get('sparse_count', True)
+    pipeline_state = param.get('pipeline_state', None)
+    timing_out = param.get('timing_out', None)
+    profile_out = param.get('profile_out', None)
+    if out_format == 'binary':
+        str_out, count_out, symeq_clust_out = 'str_out.npz', 'count_out.npy', 'symeq_clust_out.npz'
+    else:
+        str_out, count_out, symeq_clust_out = 'str_out', 'count_out', 'symeq_clust_out'
 
-str_list = parse.parse_str(data_file)
-if use_avg:
-    str_list = parse.find_avg_str(str_list)
-else:
-    str_list = parse.find_uniq_str(str_list)
-print('# of unique structures', len(str_list), flush=True)
-with open('str_out', 'w') as filehandle:
-    json.dump(str_list, filehandle)
-clust_list = parse.parse_clust(clust_in)
-sym_list = symop.find_sym(lat_in)
-symeq_clust_list = []
-for orig_clust in clust_list:
-    orig_clust = count.scale_clust(orig_clust)  # transform to scaled Cartesian coord
-    symeq_clust_list.append(symop.find_eq_clust(sym_list, orig_clust))
-with open('symeq_clust_out', 'w') as filehandle:
-    json.dump(symeq_clust_list, filehandle)
+    state = pipeline.load_state(pipeline_state)
+    if timing_out:
+        timing.count_calls(count, ['find_spec_spin', 'apply_pbc', 'find_site'])
+        timing.count_calls(symop, ['find_eq_spec_seq', 'find_deco'])
+    if profile_out:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-# write MC rule file
-# count, deco_list = parse.parse_count('count_out')
-# spec_pntsym_list = []
-# for symeq_clust in symeq_clust_list:
-#     if len(symeq_clust[0][0]) <= 2:
-#         spec_pntsym_list.append([[None]] * len(symeq_clust))
-#     else:
-#         pntsym_list = []
-#         for clust in symeq_clust:
-#             coords = clust[0]
-#             hypo_molec = Molecule(['H'] * len(coords), coords)
-#             pntsym = syman.PointGroupAnalyzer(hypo_molec).get_symmetry_operations()
-#             pntsym_list.append(pntsym)
-#         spec_pntsym_list.append(pntsym_list)
-# with open('eci_out_weighted', 'r') as filehandle:
-#     eci_list = json.load(filehandle)
-# cefit.write_eci('CLUSTERS_weighted', symeq_clust_list, deco_list, eci_list, spec_pntsym_list, species)
+    # parse and deduplicate, the structures stream from the file straight into the store
+    str_key = pipeline.stage_key(state, [data_file], {'use_avg_enrg': use_avg, 'dedup_decimals': dedup_decimals,
+                                                      'str_out': str_out})
+    timing.start('parse')
+    if pipeline.is_current(state, 'str', str_key):
+        str_store = parse.build_str_store(parse.read_str(str_out))
+    else:
+        with open(data_file) as filehandle:
+            str_store = parse.build_str_store(parse.iter_str(filehandle), 'avg' if use_avg else 'uniq', dedup_decimals)
+        parse.write_str(str_store, str_out)
+        pipeline.record(state, pipeline_state, 'str', str_key, [str_out])
+    timing.stop('parse')
+    print('# of unique structures', len(str_store['LatVec']), flush=True)
 
-if do_count:
-    spec_pntsym_list = []
-    new_clust_list = []
-    for symeq_clust in symeq_clust_list:
-        new_clust_list.append(symeq_clust[0])
-        if len(symeq_clust[0][0]) <= 2:
-            spec_pntsym_list.append([[None]] * len(symeq_clust))
+    # symmetry
+    if symeq_clust_out.endswith('.npz'):
+        sym_output = [symeq_clust_out]
+    else:
+        sym_output = [symeq_clust_out, symeq_clust_out + '.npz']  # permutations next to the JSON clusters
+    sym_key = pipeline.stage_key(state, [lat_in, clust_in], {'sym_out': sym_out,
+                                                             'symeq_clust_out': symeq_clust_out})
+    timing.start('symmetry')
+    if pipeline.is_current(state, 'sym', sym_key):
+        sym_list, symeq_clust_list, spec_perm_list = parse.parse_sym_stage(symeq_clust_out)
+    else:
+        clust_list = parse.parse_clust(clust_in)
+        clust_list = [count.scale_clust(orig_clust) for orig_clust in clust_list]  # transform to scaled Cartesian
+        sym_func = functools.partial(symop.find_sym_stage, lat_in, clust_list, sym_out)
+        if sym_cache:
+            sym_list, symeq_clust_list, spec_perm_list = cache.sym_cached(sym_func, [lat_in, clust_in], sym_cache)
         else:
-            pntsym_list = []
-            for clust in symeq_clust:
-                coords = clust[0]
-                hypo_molec = Molecule(['H'] * len(coords), coords)
-                pntsym = syman.PointGroupAnalyzer(hypo_molec).get_symmetry_operations()
-                pntsym_list.append(pntsym)
-            spec_pntsym_list.append(pntsym_list)
-    count_list = count.count_singlelattice(symeq_clust_list, spec_pntsym_list, str_list, new_clust_list)
-    with open('count_out', 'w') as filehandle:
-        json.dump(count_list, filehandle)
-    # count spin pairs
-    # count_spin_list = count.count_spin_pair(symeq_clust_list, spec_pntsym_list, str_list, new_clust_list)
-    # with open('count_spin_out', 'w') as filehandle:
-    #     json.dump(count_spin_list, filehandle)
+            sym_list, symeq_clust_list, spec_perm_list = sym_func()
+        parse.write_symeq_clust(symeq_clust_out, sym_list, symeq_clust_list, spec_perm_list)
+        pipeline.record(state, pipeline_state, 'sym', sym_key, sym_output)
+    timing.stop('symmetry')
 
-if do_fit:
-    count, deco_list = parse.parse_count('count_out')
-    if rescale_enrg:
-        enrg = parse.parse_scaled_enrg('str_out', ep_comp, ep_enrg)
-    else:
-        enrg = parse.parse_enrg('str_out')
-    all_eci = cefit.all_data_lasso(count, enrg)
-    with open('eci_out', 'w') as filehandle:
-        json.dump(all_eci, filehandle)
     # write MC rule file
-    spec_pntsym_list = []
-    for symeq_clust in symeq_clust_list:
-        if len(symeq_clust[0][0]) <= 2:
-            spec_pntsym_list.append([[None]] * len(symeq_clust))
+    # count, deco_list = parse.parse_count('count_out')
+    # with open('eci_out_weighted', 'r') as filehandle:
+    #     eci_list = json.load(filehandle)
+    # cefit.write_eci('CLUSTERS_weighted', symeq_clust_list, deco_list, eci_list, spec_perm_list, species)
+
+    # count
+    if count_out.endswith('.npy'):
+        count_output = [count_out, count_out[:-4] + '.json']
+    else:
+        count_output = [count_out]
+    count_key = pipeline.stage_key(state, [str_out, symeq_clust_out], {'count_out': count_out,
+                                                                       'count_spin_out': count_spin_out})
+    timing.start('count')
+    if do_count and not pipeline.is_current(state, 'count', count_key):
+        str_list = list(parse.iter_str_store(count.apply_basis_store(str_store)))  # views on the columnar store
+        new_clust_list = [symeq_clust[0] for symeq_clust in symeq_clust_list]
+        if count_backend == 'numba' and count.njit is None:
+            print('numba is not installed, counting with the', count_engine, 'engine', flush=True)
+        if count_backend == 'numba' and count.njit is not None:
+            count_func = count.count_jit
+        elif count_engine == 'vector':
+            count_func = functools.partial(count.count_vector, cache_size=placement_cache_size)
         else:
-            pntsym_list = []
-            for clust in symeq_clust:
-                coords = clust[0]
-                hypo_molec = Molecule(['H'] * len(coords), coords)
-                pntsym = syman.PointGroupAnalyzer(hypo_molec).get_symmetry_operations()
-                pntsym_list.append(pntsym)
-            spec_pntsym_list.append(pntsym_list)
-    with open('eci_out', 'r') as filehandle:
-        eci_list = json.load(filehandle)
-    cefit.write_eci('CLUSTERS', symeq_clust_list, deco_list, eci_list, spec_pntsym_list, species)
+            count_func = count.count_singlelattice
+        count_func = functools.partial(count_func, symeq_clust_list, spec_perm_list, clust_list=new_clust_list,
+                                       workers=count_workers)
+        if count_spin_out:  # spin pairs are counted in the same pass as the vector engine, the cache has no spin pairs
+            count_list, count_spin_list = count.count_vector(symeq_clust_list, spec_perm_list, str_list,
+                                                             new_clust_list, count_workers, spin_pair=True,
+                                                             cache_size=placement_cache_size)
+            with open(count_spin_out, 'w') as filehandle:
+                json.dump(count_spin_list, filehandle)
+        elif count_cache:
+            count_list, hit, miss = cache.count_cached(count_func, str_list, symeq_clust_list, count_cache,
+                                                       count_cache_size)
+            print('# of cached structures', hit, '# of counted structures', miss, flush=True)
+        else:
+            count_list = count_func(str_list)
+        parse.write_count(count_list, count_out)
+        pipeline.record(state, pipeline_state, 'count', count_key,
+                        count_output + ([count_spin_out] if count_spin_out else []))
+    timing.stop('count')
 
-    if fit_lasso:
-        lasso_eci = cefit.lasso_fit(count, enrg)
-        with open('eci_out_lasso', 'w') as filehandle:
-            json.dump(lasso_eci.tolist(), filehandle)
-        # write MC rules after fitting
-        with open('symeq_clust_out', 'r') as filehandle:
-            symeq_clust_list = json.load(filehandle)
-        with open('eci_out_lasso', 'r') as filehandle:
-            eci_list = json.load(filehandle)
-        cefit.write_eci('CLUSTERS_lasso', symeq_clust_list, deco_list, eci_list, spec_pntsym_list, species)
+    # fit
+    method_list = [method for method, flag in zip(['lasso', 'ridge', 'eln'], [fit_lasso, fit_ridge, fit_eln]) if flag]
+    fit_output = ['eci_out']
+    for method in method_list:
+        fit_output.extend(['eci_out_' + method, 'fit_coef_' + method, 'fit_attr_' + method])
+    fit_option = {key: param.get(key) for key in ['fit_lasso', 'fit_ridge', 'fit_eln', 'rescale_enrg', 'ep_comp',
+                                                   'ep_enrg', 'sample_times', 'sample_ratio', 'kfold', 'alpha_range',
+                                                   'l1_ratio', 'convergence', 'fit_engine', 'alpha_window',
+                                                   'ridge_gcv', 'sparse_count']}
+    if do_fit:  # the inputs of the fit and rule stages are only there when they run
+        fit_key = pipeline.stage_key(state, count_output + [str_out], fit_option)
+    deco_list = None
+    timing.start('fit')
+    if do_fit and not pipeline.is_current(state, 'fit', fit_key):
+        fit_config = cefit.load_config(param)
+        count, deco_list = parse.parse_count(count_out, sparse_count)
+        if rescale_enrg:
+            enrg = parse.parse_scaled_enrg(str_out, ep_comp, ep_enrg)
+        else:
+            enrg = parse.parse_enrg(str_out)
+        all_eci = cefit.all_data_lasso(count, enrg, fit_config)
+        with open('eci_out', 'w') as filehandle:
+            json.dump(all_eci, filehandle)
+        fit_func = {'lasso': cefit.lasso_fit, 'ridge': cefit.ridge_fit, 'eln': cefit.eln_fit}
+        for method in method_list:
+            eci = fit_func[method](count, enrg, fit_config)
+            with open('eci_out_' + method, 'w') as filehandle:
+                json.dump(eci.tolist(), filehandle)
+        pipeline.record(state, pipeline_state, 'fit', fit_key, fit_output)
+    timing.stop('fit')
 
-    if fit_ridge:
-        ridge_eci = cefit.ridge_fit(count, enrg)
-        with open('eci_out_ridge', 'w') as filehandle:
-            json.dump(ridge_eci.tolist(), filehandle)
-        # write MC rules after fitting
-        with open('symeq_clust_out', 'r') as filehandle:
-            symeq_clust_list = json.load(filehandle)
-        with open('eci_out_ridge', 'r') as filehandle:
-            eci_list = json.load(filehandle)
-        cefit.write_eci('CLUSTERS_ridge', symeq_clust_list, deco_list, eci_list, spec_pntsym_list, species)
+    # write MC rule files
+    rule_output = ['CLUSTERS'] + ['CLUSTERS_' + method for method in method_list]
+    eci_input = ['eci_out'] + ['eci_out_' + method for method in method_list]
+    if rule_replicates:  # one more rule file for each bootstrap replicate
+        eci_input.extend('fit_coef_' + method for method in method_list)
+    if do_fit:
+        rule_key = pipeline.stage_key(state, eci_input + count_output + [symeq_clust_out], {'species': species})
+    timing.start('rule')
+    if do_fit and not pipeline.is_current(state, 'rule', rule_key):
+        if deco_list is None:
+            count, deco_list = parse.parse_count(count_out, sparse_count)
+        eci_list_all = []
+        for eci_name in eci_input:
+            with open(eci_name, 'r') as filehandle:
+                eci_list_all.append(json.load(filehandle))
+        if rule_replicates:
+            coef_list_all = eci_list_all[len(method_list) + 1:]
+            eci_list_all = eci_list_all[:len(method_list) + 1]
+            for method, coef_list in zip(method_list, coef_list_all):
+                rule_output.extend('CLUSTERS_' + method + '_' + str(k) for k in range(len(coef_list)))
+                eci_list_all.extend(coef_list)
+        cefit.write_eci_list(rule_output, symeq_clust_list, deco_list, eci_list_all, spec_perm_list, species)
+        pipeline.record(state, pipeline_state, 'rule', rule_key, rule_output)
+    timing.stop('rule')
 
-    if fit_eln:
-        eln_eci = cefit.eln_fit(count, enrg)
-        with open('eci_out_eln', 'w') as filehandle:
-            json.dump(eln_eci.tolist(), filehandle)
-        # write MC rules after fitting
-        with open('symeq_clust_out', 'r') as filehandle:
-            symeq_clust_list = json.load(filehandle)
-        with open('eci_out_eln', 'r') as filehandle:
-            eci_list = json.load(filehandle)
-        cefit.write_eci('CLUSTERS_eln', symeq_clust_list, deco_list, eci_list, spec_pntsym_list, species)
+    if profile_out:
+        profiler.disable()
+        profiler.dump_stats(profile_out)
+    if timing_out:
+        timing.write_report(timing_out)
 
-print("--- %s seconds ---" % (time.time() - start_time))
+    print("--- %s seconds ---" % (time.time() - start_time))
@@ -1,5 +1,7 @@
 import json
 import numpy as np
+from scipy import sparse
+import cache
 
 
 def parse_lat(lat_in):
@@ -20,17 +22,23 @@ def parse_str(data_file):
     :param data_file: file created by the vasp_compilation code from DFT data set
     :return: parsed DFT data list (str_list)
     """
-    f = open(data_file)  # Read in DFT data
-    data = f.readlines()
-    f.close()
-    str_dict = {}  # Dictionary containing all data and metadata for each DFT calculation
-    str_list = []
-    for i in range(len(data)):  # Begin parsing DFT data file
-        if "#" in data[i]:  # "#" indicates a new DFT data point
-            elem_name = data[i].split()  # List of the chemical species in the DFT data
+    with open(data_file) as f:  # Read in DFT data
+        str_list = list(iter_str(f))
+    return str_list
+
+
+def iter_str(f):
+    """
+    Read in the DFT data one calculation at a time, so that only one structure is held in memory
+    :param f: file handle of the file created by the vasp_compilation code from DFT data set
+    :return: generator of metadata dictionaries in the same format as parse_str
+    """
+    for line in f:  # Begin parsing DFT data file
+        if "#" in line:  # "#" indicates a new DFT data point
+            elem_name = line.split()  # List of the chemical species in the DFT data
             elem_name.pop(0)
             elem_num = len(elem_name)
-            set_data = data[i + 1]
+            set_data = next(f)
             set_data = set_data.split()
             name = set_data[elem_num]
             atom_numb = [int(set_data[i]) for i in range(elem_num)]
@@ -40,7 +48,7 @@ def parse_str(data_file):
                          float(set_data[elem_num + 4])]
             lat_ang = [float(set_data[elem_num + 5]), float(set_data[elem_num + 6]),
                        float(set_data[elem_num + 7])]
-            lat_vec = [data[i + 2 + j].split() for j in range(3)]
+            lat_vec = [next(f).split() for j in range(3)]
             lat_vec = [[float(lat_vec[j][k]) for k in range(len(lat_vec[j]))] for j in range(len(lat_vec))]
             vol = lat_const[0] * lat_const[1] * lat_const[2] * np.sqrt(1 - np.power(
                 np.cos(lat_ang[0]), 2) - np.power(np.cos(lat_ang[1]), 2) - np.power(np.cos(lat_ang[2]), 2)
@@ -51,18 +59,19 @@ def parse_str(data_file):
             type_list = []
             spec_list = []
             for j in range(int(atom_sum)):
-                line = data[i + j + 5]
-                line = line.split()
-                spin = float(line[2])
-                atom_type = line[1]
-                line = [float(line[k]) for k in range(3, 6)]
-                atom_pos = line  # np.dot(np.transpose(line), lat_vec)
+                atom_line = next(f)
+                atom_line = atom_line.split()
+                spin = float(atom_line[2])
+                atom_type = atom_line[1]
+                atom_line = [float(atom_line[k]) for k in range(3, 6)]
+                atom_pos = atom_line  # np.dot(np.transpose(line), lat_vec)
                 pos_list.append(atom_pos)
                 spin_list.append(spin)
                 type_list.append(atom_type)
             for j in range(len(elem_name)):
                 for k in range(int(atom_numb[j])):
                     spec_list.append(elem_name[j])
+            str_dict = {}  # Dictionary containing all data and metadata for each DFT calculation
             str_dict['CellName'] = name  # structure names
             str_dict['LatVec'] = lat_vec  # lattice vectors in 3D
             str_dict['LatConst'] = lat_const  # lattice constants
@@ -77,31 +86,45 @@ def parse_str(data_file):
             str_dict['Spin'] = spin_list  # list of spin at each atom
             str_dict['Type'] = type_list  # list of species index of each atom
             str_dict['Spec'] = spec_list # list of species name of each atom
-            str_list.append(str_dict.copy())
-    return str_list
+            yield str_dict
+
+
+def str_fingerprint(str_dict, decimals=None):
+    """
+    hashable fingerprint of a structure, equal for structures with the same 'LatPnt', 'Spin', 'Type' and 'LatVec'
+    :param str_dict: structure metadata generated by parse_str function
+    :param decimals: round coordinates, spins and lattice vectors to this number of decimals, exact match if None
+    :return: tuple of the structure content
+    """
+    if decimals is None:
+        return (tuple(map(tuple, str_dict['LatPnt'])), tuple(str_dict['Spin']), tuple(str_dict['Type']),
+                tuple(map(tuple, str_dict['LatVec'])))
+    fingerprint = [tuple(str_dict['Type'])]
+    for key in ['LatPnt', 'Spin', 'LatVec']:
+        value = np.round(np.asarray(str_dict[key], dtype=float), decimals) + 0.0  # no -0.0
+        fingerprint.append((value.shape, tuple(value.ravel().tolist())))
+
+    return tuple(fingerprint)
 
 
-def find_avg_str(str_list):
+def find_avg_str(str_list, decimals=None):
     """
     merge redundant structure energies into an averaged energy in str_list
-    :param str_list: list of structure metadata generated by parse_str function
+    :param str_list: list or generator (iter_str) of structure metadata generated by parse_str function
+    :param decimals: number of decimals two structures need to agree on to be redundant, exact match if None
     :return: avg_str_list
     """
     avg_str_list = []
+    avg_idx = {}  # fingerprint -> index in avg_str_list
     for str_dict in str_list:
         str_dict['Num_Redund'] = 1
-        i = 0
-        while i < len(avg_str_list):
-            if str_dict['LatPnt'] == avg_str_list[i]['LatPnt'] \
-                    and str_dict['Spin'] == avg_str_list[i]['Spin'] \
-                    and str_dict['Type'] == avg_str_list[i]['Type'] \
-                    and str_dict['LatVec'] == avg_str_list[i]['LatVec']:
-                avg_str_list[i]['Enrg'] += str_dict['Enrg']
-                avg_str_list[i]['Num_Redund'] += 1
-                break
-            else:
-                i += 1
-        if i >= len(avg_str_list):
+        fingerprint = str_fingerprint(str_dict, decimals)
+        if fingerprint in avg_idx:
+            i = avg_idx[fingerprint]
+            avg_str_list[i]['Enrg'] += str_dict['Enrg']
+            avg_str_list[i]['Num_Redund'] += 1
+        else:
+            avg_idx[fingerprint] = len(avg_str_list)
             avg_str_list.append(str_dict)
 
     for str_dict in avg_str_list:
@@ -110,31 +133,126 @@ def find_avg_str(str_list):
     return avg_str_list
 
 
-def find_uniq_str(str_list):
+def find_uniq_str(str_list, decimals=None):
     """
     remove redundant structure in str_list
-    :param str_list: list of structure metadata generated by parse_str function
+    :param str_list: list or generator (iter_str) of structure metadata generated by parse_str function
+    :param decimals: number of decimals two structures need to agree on to be redundant, exact match if None
     :return: uniq_str_list
     """
     uniq_str_list = []
+    uniq_idx = {}  # fingerprint -> index in uniq_str_list
     for str_dict in str_list:
-        i = 0
-        while i < len(uniq_str_list):
-            if str_dict['LatPnt'] == uniq_str_list[i]['LatPnt'] \
-                    and str_dict['Spin'] == uniq_str_list[i]['Spin'] \
-                    and str_dict['Type'] == uniq_str_list[i]['Type'] \
-                    and str_dict['LatVec'] == uniq_str_list[i]['LatVec']:
-                if str_dict['Enrg'] < uniq_str_list[i]['Enrg']:
-                    uniq_str_list[i] = str_dict
-                break
-            else:
-                i += 1
-        if i >= len(uniq_str_list):
+        fingerprint = str_fingerprint(str_dict, decimals)
+        if fingerprint in uniq_idx:
+            i = uniq_idx[fingerprint]
+            if str_dict['Enrg'] < uniq_str_list[i]['Enrg']:
+                uniq_str_list[i] = str_dict
+        else:
+            uniq_idx[fingerprint] = len(uniq_str_list)
             uniq_str_list.append(str_dict)
 
     return uniq_str_list
 
 
+def build_str_store(str_list, dedup=None, decimals=None):
+    """
+    pack structures into a columnar store: per-atom arrays of all structures back to back with per-structure offsets
+    :param str_list: list or generator (iter_str) of structure metadata generated by parse_str function
+    :param dedup: None keeps all structures, 'uniq' keeps the lowest energy of redundant structures like find_uniq_str,
+    'avg' averages their energies like find_avg_str, redundant structures overwrite their row instead of being listed
+    :param decimals: number of decimals two structures need to agree on to be redundant, exact match if None
+    :return: str_store: dictionary of arrays like {'LatPnt': (N_atoms, 3), 'LatVec': (N_str, 3, 3), 'Offset': ...}
+    """
+    key_list = []
+    meta = {}
+    lat_vec, pos, spin, spec, atom_type, atom_num = [], [], [], [], [], []
+    spec_code = {}  # species name -> int8 code
+    type_code = {}
+    row_idx = {}  # fingerprint -> row of the store, redundant structures have the same number of atoms
+    for str_dict in str_list:
+        if dedup == 'avg':
+            str_dict['Num_Redund'] = 1
+        i = None
+        if dedup is not None:
+            fingerprint = str_fingerprint(str_dict, decimals)
+            if fingerprint in row_idx:
+                i = row_idx[fingerprint]
+                if dedup == 'avg':
+                    meta['Enrg'][i] += str_dict['Enrg']
+                    meta['Num_Redund'][i] += 1
+                    continue
+                if str_dict['Enrg'] >= meta['Enrg'][i]:
+                    continue
+            else:
+                row_idx[fingerprint] = len(lat_vec)
+        if not key_list:
+            key_list = list(str_dict.keys())
+            meta = {key: [] for key in key_list if key not in ['LatVec', 'LatPnt', 'Spin', 'Spec', 'Type']}
+        row = {'LatVec': str_dict['LatVec'],
+               'LatPnt': np.asarray(str_dict['LatPnt'], dtype=float).reshape(-1, 3),
+               'Spin': np.asarray(str_dict['Spin'], dtype=float),
+               'Spec': np.array([spec_code.setdefault(x, len(spec_code)) for x in str_dict['Spec']], dtype=np.int8),
+               'Type': np.array([type_code.setdefault(x, len(type_code)) for x in str_dict['Type']], dtype=np.int8)}
+        if i is None:
+            for key in meta:
+                meta[key].append(str_dict[key])
+            for column, key in zip([lat_vec, pos, spin, spec, atom_type], ['LatVec', 'LatPnt', 'Spin', 'Spec', 'Type']):
+                column.append(row[key])
+            atom_num.append(len(pos[-1]))
+        else:  # lower energy duplicate replaces the row
+            for key in meta:
+                meta[key][i] = str_dict[key]
+            for column, key in zip([lat_vec, pos, spin, spec, atom_type], ['LatVec', 'LatPnt', 'Spin', 'Spec', 'Type']):
+                column[i] = row[key]
+    if dedup == 'avg':
+        meta['Enrg'] = [enrg/num for enrg, num in zip(meta['Enrg'], meta['Num_Redund'])]
+    str_store = {'Keys': key_list, 'Meta': meta,
+                 'LatVec': np.array(lat_vec, dtype=float).reshape(-1, 3, 3),
+                 'LatPnt': np.concatenate(pos) if pos else np.zeros((0, 3)),
+                 'Spin': np.concatenate(spin) if spin else np.zeros(0),
+                 'Spec': np.concatenate(spec) if spec else np.zeros(0, dtype=np.int8),
+                 'Type': np.concatenate(atom_type) if atom_type else np.zeros(0, dtype=np.int8),
+                 'SpecName': np.array(list(spec_code.keys())), 'TypeName': np.array(list(type_code.keys())),
+                 'Offset': np.concatenate([[0], np.cumsum(atom_num, dtype=np.int64)])}
+
+    return str_store
+
+
+def get_str(str_store, i):
+    """
+    dictionary view of one structure in a str_store, the per-atom arrays are slices of the store without copying
+    :param str_store: columnar store from build_str_store
+    :param i: index of the structure
+    :return: str_dict with the same keys as parse_str, plus 'CartPnt' if the store has Cartesian coordinates
+    """
+    start, end = str_store['Offset'][i], str_store['Offset'][i + 1]
+    str_dict = {}
+    for key in str_store['Keys']:
+        if key == 'LatVec':
+            str_dict[key] = str_store['LatVec'][i]
+        elif key in ['LatPnt', 'Spin']:
+            str_dict[key] = str_store[key][start:end]
+        elif key in ['Spec', 'Type']:
+            str_dict[key] = str_store[key + 'Name'][str_store[key][start:end]]
+        else:
+            str_dict[key] = str_store['Meta'][key][i]
+    if 'CartPnt' in str_store:
+        str_dict['CartPnt'] = str_store['CartPnt'][start:end]
+
+    return str_dict
+
+
+def iter_str_store(str_store):
+    """
+    dictionary views of all structures in a str_store
+    :param str_store: columnar store from build_str_store
+    :return: generator of str_dict from get_str
+    """
+    for i in range(len(str_store['Offset']) - 1):
+        yield get_str(str_store, i)
+
+
 def parse_clust(clust_in):
     """
     Read in the cluster rules and return to the list of clusters
@@ -147,34 +265,158 @@ def parse_clust(clust_in):
     return clust_list
 
 
-def parse_count(count_out):
+def write_str(str_store, str_out):
     """
-    read the count_out file to get a list containing all possible cluster (motifs and decorations)
-    :param count_out: file name with counting results
-    :return: count list for all structures in a specific sequence
+    write the structure metadata, as JSON or as a binary .npz file if str_out ends with '.npz'
+    :param str_store: columnar store from build_str_store
+    :param str_out: file name for the structure metadata
+    """
+    if str_out.endswith('.npz'):
+        header = json.dumps({'Keys': str_store['Keys'], 'Meta': str_store['Meta']})
+        with open(str_out, 'wb') as filehandle:
+            np.savez(filehandle, header=header, **{key: str_store[key] for key in [
+                'LatVec', 'LatPnt', 'Spin', 'Spec', 'Type', 'SpecName', 'TypeName', 'Offset']})
+    else:
+        str_list = []
+        for str_dict in iter_str_store(str_store):
+            str_list.append({key: str_dict[key].tolist() if isinstance(str_dict[key], np.ndarray) else str_dict[key]
+                             for key in str_store['Keys']})
+        with open(str_out, 'w') as filehandle:
+            json.dump(str_list, filehandle)
+
+
+def read_str(str_out):
+    """
+    read the structure metadata written by write_str
+    :param str_out: file name for the structure metadata
+    :return: list of structure metadata
+    """
+    if str_out.endswith('.npz'):
+        with np.load(str_out) as data:
+            str_store = {key: data[key] for key in data.files if key != 'header'}
+            str_store.update(json.loads(str(data['header'])))
+        return list(iter_str_store(str_store))
+    with open(str_out, 'r') as filehandle:
+        str_list = json.load(filehandle)
+    return str_list
+
+
+def write_symeq_clust(symeq_clust_out, sym_list, symeq_clust_list, perm_list):
+    """
+    write the symmetry equivalent clusters, as JSON or as a binary .npz file if symeq_clust_out ends with '.npz', the
+    JSON file gets the whole symmetry stage in a binary .npz file next to it so the point symmetry is not found again
+    :param symeq_clust_out: file name for the symmetry equivalent clusters
+    :param sym_list: list of symmetry operations
+    :param symeq_clust_list: all symmetry equivalent clusters
+    :param perm_list: point symmetry site permutations of all symmetry equivalent clusters
+    """
+    if symeq_clust_out.endswith('.npz'):
+        cache.save_sym(symeq_clust_out, sym_list, symeq_clust_list, perm_list)
+    else:
+        with open(symeq_clust_out, 'w') as filehandle:
+            json.dump(symeq_clust_list, filehandle)
+        cache.save_sym(symeq_clust_out + '.npz', sym_list, symeq_clust_list, perm_list)
+
+
+def parse_symeq_clust(symeq_clust_out):
+    """
+    read the symmetry equivalent clusters written by write_symeq_clust
+    :param symeq_clust_out: file name for the symmetry equivalent clusters
+    :return: all symmetry equivalent clusters
+    """
+    if symeq_clust_out.endswith('.npz'):
+        return cache.load_sym(symeq_clust_out)[1]
+    with open(symeq_clust_out, 'r') as filehandle:
+        symeq_clust_list = json.load(filehandle)
+    return symeq_clust_list
+
+
+def parse_sym_stage(symeq_clust_out):
+    """
+    read the whole symmetry stage written by write_symeq_clust
+    :param symeq_clust_out: file name for the symmetry equivalent clusters
+    :return: list of symmetry operations, symmetry equivalent clusters and their point symmetry site permutations
+    """
+    if symeq_clust_out.endswith('.npz'):
+        return cache.load_sym(symeq_clust_out)
+    sym_list, symeq_clust_list, perm_list = cache.load_sym(symeq_clust_out + '.npz')
+
+    return sym_list, parse_symeq_clust(symeq_clust_out), perm_list
+
+
+def count_matrix(count_list):
     """
-    with open(count_out, 'r') as filehandle:
-        count_list = json.load(filehandle)
-    deco_list = [[] for _ in count_list[0][1]]
+    turn the counting results into a sparse count matrix with one column per cluster decoration
+    :param count_list: counting results from count_singlelattice
+    :return: CSR count matrix for all structures in a specific sequence, decoration list of each cluster
+    """
+    deco_list = [{} for _ in count_list[0][1]]  # dict as an ordered set of the decorations of each cluster
     for i in range(len(count_list)):
         for j in range(len(count_list[i][1])):
-            key_name = list(count_list[i][1][j][4].keys())
-            for deco in key_name:
-                if deco not in deco_list[j]:
-                    deco_list[j].append(deco)
+            deco_list[j].update(dict.fromkeys(count_list[i][1][j][4]))
+    deco_list = [sorted(deco) for deco in deco_list]
+    col_index = []  # decoration -> column of the count matrix, per cluster
+    col = 0
     for deco in deco_list:
-        deco.sort()
-    count = [[] for _ in count_list]
+        col_index.append({key: col + k for k, key in enumerate(deco)})
+        col += len(deco)
+    data = []
+    indices = []
+    indptr = [0]
     for i in range(len(count_list)):
-        for j in range(len(deco_list)):
-            key_name = list(count_list[i][1][j][4].keys())
-            for deco in deco_list[j]:
-                if deco in key_name:
-                    count[i].append(count_list[i][1][j][4][deco])
-                else:
-                    count[i].append(0)
-    print('# of input structures:', len(count_list))
-    print('# of input clusters with decoration:', len(count[0]), flush=True)
+        for j in range(len(count_list[i][1])):
+            for deco, num in count_list[i][1][j][4].items():
+                indices.append(col_index[j][deco])
+                data.append(num)
+        indptr.append(len(indices))
+    count = sparse.csr_matrix((np.array(data, dtype=float), np.array(indices, dtype=np.int32), np.array(indptr)),
+                              shape=(len(count_list), col))
+    count.sort_indices()
+    count.eliminate_zeros()  # spin sums can cancel
+
+    return count, deco_list
+
+
+def write_count(count_list, count_out):
+    """
+    write the counting results, as JSON or, if count_out ends with '.npy', as a dense count matrix that can be
+    memory mapped plus a JSON header with the structure names, clusters and decorations
+    :param count_list: counting results from count_singlelattice
+    :param count_out: file name for the counting results
+    """
+    if count_out.endswith('.npy'):
+        count, deco_list = count_matrix(count_list)
+        np.save(count_out, count.toarray())
+        header = {'CellName': [x[0] for x in count_list], 'Clust': [x[:4] for x in count_list[0][1]] if count_list
+                  else [], 'Deco': deco_list}
+        with open(count_out[:-4] + '.json', 'w') as filehandle:
+            json.dump(header, filehandle)
+    else:
+        with open(count_out, 'w') as filehandle:
+            json.dump(count_list, filehandle)
+
+
+def parse_count(count_out, sparse_count=True):
+    """
+    read the count_out file to get a list containing all possible cluster (motifs and decorations)
+    :param count_out: file name with counting results, a memory mapped count matrix if it ends with '.npy'
+    :param sparse_count: return a CSR count matrix if True, a dense array otherwise
+    :return: count matrix for all structures in a specific sequence, decoration list of each cluster
+    """
+    if count_out.endswith('.npy'):
+        count = np.load(count_out, mmap_mode='r')
+        with open(count_out[:-4] + '.json', 'r') as filehandle:
+            deco_list = json.load(filehandle)['Deco']
+        if sparse_count:
+            count = sparse.csr_matrix(count)
+    else:
+        with open(count_out, 'r') as filehandle:
+            count_list = json.load(filehandle)
+        count, deco_list = count_matrix(count_list)
+        if not sparse_count:
+            count = count.toarray()
+    print('# of input structures:', count.shape[0])
+    print('# of input clusters with decoration:', count.shape[1], flush=True)
 
     return count, deco_list
 
@@ -185,8 +427,7 @@ def parse_enrg(str_out):
     :param str_out: file name with structure metadata
     :return: enrg
     """
-    with open(str_out, 'r') as filehandle:
-        str_list = json.load(filehandle)
+    str_list = read_str(str_out)
     enrg = []
     for str_dict in str_list:
         enrg.append(str_dict['Enrg'])
@@ -202,8 +443,7 @@ def parse_scaled_enrg(str_out, ep_comp, ep_enrg):
     :param ep_enrg: endpoint energy in a list like [-1, -2, -3]
     :return:
     """
-    with open(str_out, 'r') as filehandle:
-        str_list = json.load(filehandle)
+    str_list = read_str(str_out)
     enrg = []
     for str_dict in str_list:
         raw_enrg = str_dict['Enrg']
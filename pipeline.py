@@ -0,0 +1,81 @@
+import os
+import json
+import hashlib
+import cache
+
+PIPELINE_VERSION = 1  # bump when a stage changes its results
+PIPELINE_MODULES = ['main', 'parse', 'count', 'symop', 'cefit', 'cache', 'pipeline', 'timing']
+_code_hash = None  # hash of the source of PIPELINE_MODULES, computed on first use
+
+
+def stage_key(state, file_list, option):
+    """
+    hash the inputs of a stage
+    :param state: recorded stages from load_state, None if the pipeline state is not kept
+    :param file_list: input files of the stage
+    :param option: dictionary of the param_in options the stage depends on
+    :return: hex digest of the input files, options, pipeline version and the source of the pipeline modules, None
+             without hashing anything if state is None
+    """
+    global _code_hash
+    if state is None:
+        return None
+    if _code_hash is None:
+        source_dir = os.path.dirname(os.path.abspath(__file__))
+        _code_hash = cache.hash_file([os.path.join(source_dir, name + '.py') for name in PIPELINE_MODULES])
+    sha = hashlib.sha1(cache.hash_file(file_list).encode())
+    sha.update(json.dumps(option, sort_keys=True).encode())
+    sha.update(str(PIPELINE_VERSION).encode())
+    sha.update(_code_hash.encode())  # any change of the pipeline code reruns every stage
+
+    return sha.hexdigest()
+
+
+def load_state(state_file):
+    """
+    read the recorded stages
+    :param state_file: name of the pipeline state file, None to rerun every stage
+    :return: dictionary of stage name to input key and output hashes, None if state_file is None
+    """
+    if state_file is None:
+        return None
+    if not os.path.isfile(state_file):
+        return {}
+    with open(state_file, 'r') as filehandle:
+        state = json.load(filehandle)
+
+    return state
+
+
+def is_current(state, stage, key):
+    """
+    check if a stage ran with the same inputs and its outputs are unchanged since
+    :param state: recorded stages from load_state, None if the pipeline state is not kept
+    :param stage: name of the stage
+    :param key: input key of the stage from stage_key
+    :return: True if the stage can be skipped
+    """
+    if state is None or stage not in state or state[stage]['Key'] != key:
+        return False
+    for name, digest in state[stage]['Output'].items():
+        if not os.path.isfile(name) or cache.hash_file([name]) != digest:
+            return False
+
+    return True
+
+
+def record(state, state_file, stage, key, output_list):
+    """
+    record a finished stage with its input key and output hashes
+    :param state: recorded stages from load_state, updated in place, None to keep nothing and hash nothing
+    :param state_file: name of the pipeline state file
+    :param stage: name of the stage
+    :param key: input key of the stage from stage_key
+    :param output_list: output files of the stage
+    """
+    if state is None:
+        return
+    state[stage] = {'Key': key, 'Output': {name: cache.hash_file([name]) for name in output_list}}
+    with open(state_file + '.tmp', 'w') as filehandle:
+        json.dump(state, filehandle, indent=1)
+    os.replace(state_file + '.tmp', state_file)  # a crash in a later stage keeps the finished ones
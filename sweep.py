@@ -0,0 +1,41 @@
+import parse
+import cefit
+import json
+import time
+import yaml
+
+
+if __name__ == '__main__':  # sweep workers re-import this module on spawn
+    start_time = time.time()
+    with open('param_in', 'r') as filehandle:
+        param = yaml.safe_load(filehandle)
+    rescale_enrg = param['rescale_enrg']
+    ep_comp = param['ep_comp']
+    ep_enrg = param['ep_enrg']
+    method_list = [method for method in ['lasso', 'ridge', 'eln'] if param['fit_' + method]]
+    sparse_count = param.get('sparse_count', True)
+    sweep_grid = param['sweep']
+    sweep_dir = param.get('sweep_dir', 'sweep')
+    sweep_out = param.get('sweep_out', 'sweep_out')
+    sweep_workers = int(param.get('sweep_workers', 1))
+    if param.get('out_format', 'json') == 'binary':
+        str_out, count_out = 'str_out.npz', 'count_out.npy'
+    else:
+        str_out, count_out = 'str_out', 'count_out'
+
+    # count matrix and energies are loaded once for all sweep points
+    count, deco_list = parse.parse_count(count_out, sparse_count)
+    if rescale_enrg:
+        enrg = parse.parse_scaled_enrg(str_out, ep_comp, ep_enrg)
+    else:
+        enrg = parse.parse_enrg(str_out)
+    summary = cefit.sweep(count, enrg, param, sweep_grid, method_list, sweep_dir, sweep_workers)
+    with open(sweep_out, 'w') as filehandle:
+        # cv_mse is the lowest mean CV MSE of lasso and eln, cv_r2 the mean fold R2 of ridge, nan for the others
+        filehandle.write('# point ' + ' '.join(sweep_grid.keys()) + ' method alpha rmse cv_mse cv_r2 eci_num\n')
+        for k, point, method, alpha, rmse, cv_mse, cv_r2, eci_num in summary:
+            value_list = [json.dumps(value, separators=(',', ':')) for value in point.values()]
+            filehandle.write(' '.join(map(str, [k] + value_list + [method, alpha, rmse, cv_mse, cv_r2, eci_num])) +
+                             '\n')
+
+    print("--- %s seconds ---" % (time.time() - start_time))
@@ -1,36 +1,36 @@
+import os
 import copy
+import itertools
 import numpy as np
 from pymatgen.core import Structure, Molecule
 from pymatgen.symmetry import analyzer as syman
 from pymatgen.symmetry import site_symmetries as symsite
 
 
-def find_sym(lat_in):
+_sym_cache = {}
+
+
+def find_sym(lat_in, sym_out=None):
     """
     find the site symmetry of a given lattice from input lattice file defined like ATAT
     :param lat_in: lattice file
-    :return: list of symmetry operations
+    :param sym_out: file to write the pymatgen site symmetries to for debugging, not written if None
+    :return: array of symmetry operations (rotation matrices) in the shape of (N_ops, 3, 3)
     """
+    key = (os.path.abspath(lat_in), os.path.getmtime(lat_in), os.path.getsize(lat_in))
+    if key in _sym_cache and sym_out is None:
+        return _sym_cache[key].copy()
     struct = Structure.from_file(lat_in)
     struct = syman.SpacegroupAnalyzer(struct).find_primitive()
     pmg_sym = symsite.get_site_symmetries(struct, 0.1)
-    f = open('sym_out', 'w+')
-    f.write(str(pmg_sym))
-    f.close()
-    lines = open('sym_out', 'r').read().split('\n')
-    sym_list = []
-    for i in range(len(lines)):
-        if ':' in lines[i]:
-            s = []
-            for j in range(1, 4):
-                a = lines[i + j].replace('[', '')
-                b = a.replace(']', '')
-                c = b.split()
-                d = [round(float(c[0]), 5), round(float(c[1]), 5), round(float(c[2]), 5)]
-                s.append(d)
-            sym_list.append(s)
-
-    return sym_list
+    if sym_out is not None:
+        with open(sym_out, 'w+') as f:
+            f.write(str(pmg_sym))
+    sym_list = np.array([sym_op.rotation_matrix for site_sym in pmg_sym for sym_op in site_sym], dtype=float)
+    sym_list = np.round(sym_list.reshape(-1, 3, 3), 5)
+    _sym_cache[key] = sym_list
+
+    return sym_list.copy()
 
 
 def calc_dist(pnt1, pnt2):
@@ -184,12 +184,146 @@ def find_eq_clust(sym_list, clust):
         return symeq_clust_list
 
 
-def find_eq_spec_seq(spec, clust, pntsym):
+def apply_pntsym(coords, sym_op):
+    """
+    apply a point symmetry operation to the sites of a cluster, rounded to 5 decimals like find_eq_spec_seq
+    :param coords: site coordinates of a cluster from symeq_clust_list
+    :param sym_op: point symmetry operation
+    :return: list of new site coordinates in the same sequence as coords
+    """
+    molec = Molecule(['H'] * len(coords), coords)
+    molec.apply_operation(sym_op)
+    new_coords = []
+    for i in range(len(coords)):
+        pnt = str(molec[i])
+        a = pnt.replace('[', '')
+        b = a.replace(']', '')
+        c = b.split()
+        new_coords.append([round(float(c[0]), 5), round(float(c[1]), 5), round(float(c[2]), 5)])
+
+    return new_coords
+
+
+def find_site_order(clust, pntsym):
+    """
+    find the site sequence each point symmetry operation induces on a cluster, i.e. the sequence in which the
+    species are read after applying the operation and sorting the sites by distance
+    :param clust: site-sorted cluster from symeq_clust_list
+    :param pntsym: point symmetry for the cluster
+    :return: list of distinct site sequences like [[0, 1, 2], [1, 0, 2]]
+    """
+    order_list = []
+    for sym_op in pntsym:
+        new_clust = apply_pntsym(clust[0], sym_op)
+        for i in range(len(new_clust)):
+            new_clust[i].append(i)  # site index in place of the species, sites never tie on coordinates
+        new_clust.sort()
+        sort_coord_dist(new_clust)
+        order = [site[3] for site in new_clust]
+        if order not in order_list:
+            order_list.append(order)
+
+    return order_list
+
+
+def find_pntsym_perm(clust):
+    """
+    find the point symmetry of a cluster as site permutations, so that no pymatgen object is needed afterwards
+    :param clust: site-sorted cluster from symeq_clust_list
+    :return: array of distinct site permutations in the shape of (N_ops, size), None for points and pairs
+    """
+    coords = clust[0]
+    if len(coords) <= 2:
+        return None
+    hypo_molec = Molecule(['H'] * len(coords), coords)
+    pntsym = syman.PointGroupAnalyzer(hypo_molec).get_symmetry_operations()
+
+    return np.array(find_site_order(clust, pntsym), dtype=np.int8)
+
+
+def find_perm_list(symeq_clust_list):
+    """
+    find the point symmetry site permutations for all symmetry equivalent clusters
+    :param symeq_clust_list: all symmetry equivalent clusters
+    :return: nested list of site permutations in the same shape as symeq_clust_list
+    """
+    perm_list = []
+    for symeq_clust in symeq_clust_list:
+        perm_list.append([find_pntsym_perm(clust) for clust in symeq_clust])
+
+    return perm_list
+
+
+def find_sym_stage(lat_in, clust_list, sym_out=None):
+    """
+    find everything about symmetry the counting and the rule files need, in one pass
+    :param lat_in: lattice file
+    :param clust_list: clusters from clust_in file in scaled Cartesian coordinate
+    :param sym_out: file to write the pymatgen site symmetries to for debugging, not written if None
+    :return: list of symmetry operations, symmetry equivalent clusters and their point symmetry site permutations
+    """
+    sym_list = find_sym(lat_in, sym_out)
+    symeq_clust_list = []
+    for clust in clust_list:
+        symeq_clust_list.append(find_eq_clust(sym_list, copy.deepcopy(clust)))
+    perm_list = find_perm_list(symeq_clust_list)
+
+    return sym_list, symeq_clust_list, perm_list
+
+
+def build_deco_table(clust, perm, spec_seq):
+    """
+    map every species sequence of a cluster to its only true equivalent sequence, same as find_eq_spec_seq
+    :param clust: site-sorted cluster from symeq_clust_list
+    :param perm: point symmetry site permutations for the cluster
+    :param spec_seq: species order like ['Fe', 'Ni', 'Cr']
+    :return: dictionary like {('Fe', 'Ni', 'Cr'): 'Cr, Fe, Ni'}
+    """
+    deco_table = {}
+    for spec in itertools.product(spec_seq, repeat=len(clust[0])):
+        deco_table[spec] = find_eq_spec_seq(list(spec), clust, perm)
+
+    return deco_table
+
+
+def build_deco_table_list(symeq_clust_list, perm_list, spec_seq):
+    """
+    build the decoration tables for all symmetry equivalent clusters
+    :param symeq_clust_list: all symmetry equivalent clusters
+    :param perm_list: all point symmetry site permutations for the given clusters
+    :param spec_seq: species order like ['Fe', 'Ni', 'Cr']
+    :return: nested list of decoration tables in the same shape as symeq_clust_list
+    """
+    deco_table_list = []
+    for i in range(len(symeq_clust_list)):
+        deco_table_list.append([build_deco_table(symeq_clust_list[i][k], perm_list[i][k], spec_seq)
+                                for k in range(len(symeq_clust_list[i]))])
+
+    return deco_table_list
+
+
+def find_deco(deco_table, spec, clust, perm):
+    """
+    look up the only true equivalent sequence of a species sequence, adding it to the table if it is missing
+    :param deco_table: decoration table of the cluster from build_deco_table
+    :param spec: input species sequence in list like ['Fe', 'Ni', 'Cr']
+    :param clust: site-sorted cluster from symeq_clust_list
+    :param perm: point symmetry site permutations for the cluster
+    :return: the first item in the sorted list of equivalent species sequences
+    """
+    spec = tuple(spec)
+    if spec not in deco_table:
+        deco_table[spec] = find_eq_spec_seq(list(spec), clust, perm)
+
+    return deco_table[spec]
+
+
+def find_eq_spec_seq(spec, clust, perm):
     """
     find all equivalent species sequences in a given cluster
     :param spec: input species sequence in list like ['Fe', 'Ni', 'Cr']
     :param clust: site-sorted cluster from symeq_clust_list
-    :param pntsym: point symmetry for the cluster
+    :param perm: point symmetry site permutations for the cluster
     :return: the first item in the sorted list of equivalent species sequences
     """
     if len(spec) == 1:
@@ -199,41 +333,19 @@ def find_eq_spec_seq(spec, clust, pntsym):
         spec.sort()
         return ', '.join(map(str, spec))
     elif len(spec) >= 3:
-        coords = clust[0]
         new_spec_list = []
-        new_clust_list = []
-        for sym_op in pntsym:
-            new_clust = [[]] * len(spec)
-            molec = Molecule(spec, coords)
-            molec.apply_operation(sym_op)  # apply pnt_sym to get different spec sequence
-            for i in range(len(spec)):
-                pnt = str(molec[i])
-                a = pnt.replace('[', '')
-                b = a.replace(']', '')
-                c = b.split()
-                d = [round(float(c[0]), 5), round(float(c[1]), 5), round(float(c[2]), 5), str(c[3])]
-                new_clust[i] = d
-            new_clust.sort()  # sort first by coordinates to get rid of repeated spec sequence
-            new_clust_list.append(new_clust)
-        new_clust_list = [x for n, x in enumerate(new_clust_list) if x not in new_clust_list[:n]]
-        for i in range(len(new_clust_list)):
-            new_clust = new_clust_list[i]
-            sort_coord_dist(new_clust)  # sort by distance to the right spec sequence
-            new_spec = []
-            for j in range(len(new_clust)):
-                new_spec.append(str(new_clust[j][3]))
-            new_spec = ', '.join(map(str, new_spec))
-            new_spec_list.append(new_spec)
+        for order in perm:
+            new_spec_list.append(', '.join(str(spec[x]) for x in order))
         new_spec_list.sort()
         return new_spec_list[0]
 
 
-def find_eq_spec_list(spec, clust, pntsym, spec_seq):
+def find_eq_spec_list(spec, clust, perm, spec_seq):
     """
     find all equivalent species sequences in a given cluster
     :param spec: input species sequence like []
     :param clust: site-sorted cluster from symeq_clust_list
-    :param pntsym: point symmetry for the cluster
+    :param perm: point symmetry site permutations for the cluster
     :param spec_seq: species order like ['Fe', 'Ni', 'Cr']
     :return: the sorted list of equivalent species sequences in string like ['0, 1, 0', '0, 0, 1']
     """
@@ -260,29 +372,8 @@ def find_eq_spec_list(spec, clust, pntsym, spec_seq):
             spec2 = ', '.join(map(str, spec2))
             new_spec_list = [str(spec1), str(spec2)]
     elif len(spec) >= 3:
-        coords = clust[0]
-        new_clust_list = []
-        for sym_op in pntsym:
-            new_clust = [[]] * len(spec)
-            molec = Molecule(spec, coords)
-            molec.apply_operation(sym_op)  # apply pnt_sym to get different spec sequence
-            for i in range(len(spec)):
-                pnt = str(molec[i])
-                a = pnt.replace('[', '')
-                b = a.replace(']', '')
-                c = b.split()
-                d = [round(float(c[0]), 5), round(float(c[1]), 5), round(float(c[2]), 5), str(c[3])]
-                new_clust[i] = d
-            new_clust.sort()  # sort first by coordinates to get rid of repeated spec sequence
-            new_clust_list.append(new_clust)
-        new_clust_list = [x for n, x in enumerate(new_clust_list) if x not in new_clust_list[:n]]
-        for i in range(len(new_clust_list)):
-            new_spec = []
-            new_clust = new_clust_list[i]
-            sort_coord_dist(new_clust)  # sort by distance to the right spec sequence
-            for j in range(len(new_clust)):
-                new_spec.append(str(spec_seq.index(new_clust[j][3])))
-            new_spec_list.append(', '.join(map(str, new_spec)))
+        for order in perm:
+            new_spec_list.append(', '.join(str(spec_seq.index(spec[x])) for x in order))
     new_spec_list = [x for n, x in enumerate(new_spec_list) if x not in new_spec_list[:n]]
     new_spec_list.sort()
     return new_spec_list
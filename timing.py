@@ -0,0 +1,70 @@
+import time
+import json
+import functools
+
+_report = {'Stage': {}, 'Clust': {}, 'Call': {}, 'Replicate': {}}  # filled during the run, see write_report
+_start = {}
+
+
+def start(stage):
+    """
+    start the wall and CPU clock of a stage
+    :param stage: name of the stage
+    """
+    _start[stage] = (time.perf_counter(), time.process_time())
+
+
+def stop(stage):
+    """
+    stop the clock of a stage and add the elapsed wall and CPU time to the report
+    :param stage: name of the stage given to start
+    """
+    wall, cpu = _start.pop(stage)
+    entry = _report['Stage'].setdefault(stage, {'Wall': 0.0, 'CPU': 0.0})
+    entry['Wall'] += time.perf_counter() - wall
+    entry['CPU'] += time.process_time() - cpu
+
+
+def add_clust(index, seconds):
+    """
+    add counting time of a cluster
+    :param index: index of the cluster in clust_in
+    :param seconds: wall time spent on the cluster
+    """
+    _report['Clust'][str(index)] = _report['Clust'].get(str(index), 0.0) + seconds
+
+
+def add_replicate(method, seconds):
+    """
+    add the fitting time of a bootstrap replicate
+    :param method: fitting method like 'lasso'
+    :param seconds: wall time of the replicate
+    """
+    _report['Replicate'].setdefault(method, []).append(seconds)
+
+
+def count_calls(module, name_list):
+    """
+    replace functions of a module with wrappers counting their calls, calls from inside the module are counted too
+    :param module: module like count
+    :param name_list: names of the functions to count
+    """
+    for name in name_list:
+        func = getattr(module, name)
+        key = module.__name__ + '.' + name
+        _report['Call'][key] = 0
+
+        def wrapper(*args, _func=func, _key=key, **kwargs):
+            _report['Call'][_key] += 1
+            return _func(*args, **kwargs)
+
+        setattr(module, name, functools.wraps(func)(wrapper))
+
+
+def write_report(name):
+    """
+    write the collected times and call counts as JSON
+    :param name: name of the report file
+    """
+    with open(name, 'w') as filehandle:
+        json.dump(_report, filehandle, indent=1)